@@ -0,0 +1,113 @@
+import base64
+import json
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+logger = logging.getLogger()
+
+# accounts imported at once by one invocation
+account_workers = int(os.getenv("ETL_ACCOUNT_WORKERS", "4"))
+# accounts per shard event sent out by the coordinator
+shard_size = int(os.getenv("ETL_SHARD_SIZE", "10"))
+# local runs the shard events in this process, pubsub publishes them to ETL_SHARD_TOPIC
+# (projects/<project>/topics/<topic>) for a pubsub triggered deployment of import_data
+dispatcher_type = os.getenv("ETL_DISPATCHER", "local")
+shard_topic = os.getenv("ETL_SHARD_TOPIC", "")
+
+# The event given to import_data picks the accounts an invocation imports:
+#   {}                               every account in the fb_account_id secret
+#   {"accounts": ["123", "456"]}     just these accounts
+#   {"shard": 0, "shards": 4}        every 4th account of the secret's list, from the first
+#   {"coordinate": true}             import nothing, send one shard event per shard_size
+#                                    accounts to the dispatcher
+
+
+# the event payload as a dict, from an http request, a pubsub message or a plain dict
+def parse_event(event):
+    if hasattr(event, "get_json"):
+        return event.get_json(silent=True) or {}
+    if not isinstance(event, dict):
+        return {}
+    if "data" in event:
+        data = base64.b64decode(event["data"]).decode("utf-8")
+        return json.loads(data) if data else {}
+    return event
+
+
+# account ids without the act_ prefix, from a list or a comma separated string
+def account_ids(accounts):
+    if isinstance(accounts, str):
+        accounts = accounts.split(",")
+    ids = []
+    for account in accounts:
+        account = str(account).strip()
+        if account.startswith("act_"):
+            account = account[4:]
+        if account and account not in ids:
+            ids.append(account)
+    return ids
+
+
+# the accounts an event asks for, out of every configured account.  Accounts that aren't
+# configured are logged and left out, an event can't import an account with our token
+# that the fb_account_id secret doesn't list
+def select_accounts(payload, all_accounts):
+    all_accounts = account_ids(all_accounts)
+    if "accounts" in payload:
+        configured = set(all_accounts)
+        requested = account_ids(payload["accounts"])
+        unknown = [account for account in requested if account not in configured]
+        if unknown:
+            logger.error(
+                "Skipping accounts that aren't configured: " + ", ".join(unknown)
+            )
+        return [account for account in requested if account in configured]
+    if "shard" in payload:
+        return all_accounts[int(payload["shard"]) :: int(payload["shards"])]
+    return all_accounts
+
+
+# one {"accounts": [...]} event per size accounts
+def make_shards(accounts, size=None):
+    if size is None:
+        size = shard_size
+    accounts = account_ids(accounts)
+    return [{"accounts": accounts[i : i + size]} for i in range(0, len(accounts), size)]
+
+
+# local stand-in for the pubsub fan-out.  Hands every shard event to handler (import_data)
+# on its own thread, the way each would run in its own function instance
+class LocalDispatcher:
+    def __init__(self, handler, max_workers=None):
+        self.handler = handler
+        self.max_workers = max_workers or account_workers
+
+    def dispatch(self, events):
+        if not events:
+            return []
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            return list(pool.map(self.handler, events))
+
+
+# publishes every shard event to a pubsub topic, each message triggers one import_data
+class PubSubDispatcher:
+    def __init__(self, topic):
+        # imported here, only the coordinator needs it
+        from google.cloud import pubsub_v1
+
+        self.publisher = pubsub_v1.PublisherClient()
+        self.topic = topic
+
+    def dispatch(self, events):
+        futures = [
+            self.publisher.publish(self.topic, json.dumps(event).encode("utf-8"))
+            for event in events
+        ]
+        return [future.result() for future in futures]
+
+
+def get_dispatcher(handler):
+    if dispatcher_type == "pubsub":
+        return PubSubDispatcher(shard_topic)
+    return LocalDispatcher(handler)
@@ -0,0 +1,110 @@
+import os
+import time
+from collections import deque
+
+import metrics
+import resilience
+
+# submit insights queries as async report runs instead of the synchronous get_insights.
+# Use for long backfills and breakdowns that time out or get throttled synchronously
+use_async_reports = os.getenv("INSIGHTS_ASYNC", "False") == "True"
+max_jobs_in_flight = int(os.getenv("INSIGHTS_ASYNC_JOBS", "3"))
+poll_interval = float(os.getenv("INSIGHTS_ASYNC_POLL_SECONDS", "5"))
+
+JOB_COMPLETED = "Job Completed"
+JOB_FAILED = "Job Failed"
+JOB_SKIPPED = "Job Skipped"
+
+
+# report runs against the Graph API through the facebook_business sdk
+class GraphReportClient:
+    def __init__(self, account, fields, result_limit=1000):
+        self.account = account
+        self.fields = fields
+        self.result_limit = result_limit
+
+    @resilience.retrying("graph")
+    def submit(self, params):
+        return self.account.get_insights(self.fields, params, is_async=True)
+
+    @resilience.retrying("graph")
+    def status(self, job):
+        job.api_get()
+        return job["async_status"]
+
+    def results(self, job):
+        # a cursor, result pages are fetched as it is iterated
+        return job.get_result(params={"limit": self.result_limit})
+
+
+# local stand-in for the Graph API so the scheduler can run offline.  Jobs complete after
+# polls_to_complete status checks and return the rows whose date_start is in the time range
+class LocalReportClient:
+    def __init__(self, rows, polls_to_complete=1, fail_first=0):
+        self.rows = rows
+        self.polls_to_complete = polls_to_complete
+        self.fail_first = fail_first
+        self.submitted = 0
+
+    def submit(self, params):
+        self.submitted = self.submitted + 1
+        return {
+            "params": params,
+            "polls": 0,
+            "fail": self.submitted <= self.fail_first,
+        }
+
+    def status(self, job):
+        job["polls"] = job["polls"] + 1
+        if job["polls"] < self.polls_to_complete:
+            return "Job Running"
+        if job["fail"]:
+            return JOB_FAILED
+        return JOB_COMPLETED
+
+    def results(self, job):
+        time_range = job["params"]["time_range"]
+        for row in self.rows:
+            if time_range["since"] <= row.get("date_start") <= time_range["until"]:
+                yield row
+
+
+# submit one report run per set of query params, keeping up to max_in_flight jobs running
+# at once.  Yields (params, rows) as each job finishes, which is not necessarily the order
+# the params were given in.  Failed jobs are resubmitted up to max_attempts times
+def run_report_jobs(
+    client, params_list, max_in_flight=None, interval=None, max_attempts=3
+):
+    if max_in_flight is None:
+        max_in_flight = max_jobs_in_flight
+    if interval is None:
+        interval = poll_interval
+
+    pending = deque((params, 1) for params in params_list)
+    in_flight = []
+    while pending or in_flight:
+        while pending and len(in_flight) < max_in_flight:
+            params, attempt = pending.popleft()
+            in_flight.append((params, attempt, client.submit(params)))
+            metrics.increment("async_reports_submitted")
+
+        finished = []
+        for entry in in_flight:
+            params, attempt, job = entry
+            status = client.status(job)
+            if status == JOB_COMPLETED:
+                finished.append(entry)
+                yield params, client.results(job)
+            elif status in (JOB_FAILED, JOB_SKIPPED):
+                finished.append(entry)
+                if attempt >= max_attempts:
+                    raise RuntimeError(
+                        "Insights report failed for " + str(params["time_range"])
+                    )
+                pending.append((params, attempt + 1))
+
+        for entry in finished:
+            in_flight.remove(entry)
+        if not finished and in_flight:
+            with metrics.timer("async_report_wait"):
+                time.sleep(interval)
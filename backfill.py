@@ -0,0 +1,284 @@
+# Reload insights for any date range and set of accounts.  The range is split into
+# windows of up to INSIGHTS_WINDOW_DAYS days per account, the windows run in parallel
+# under one shared rate limit and every finished window is checkpointed, so running the
+# same backfill again after a crash or timeout only does the windows that are left.
+#
+#   python backfill.py --since 2024-01-01 --until 2024-12-31 --accounts 123,456
+#
+# or send import_data {"backfill": {"since": "2024-01-01", "until": "2024-12-31"}}
+import argparse
+import contextvars
+import datetime
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from google.cloud import bigquery
+from google.cloud.exceptions import NotFound
+
+import accounts
+import clients
+import facebook
+import fetch_executor
+import metrics
+import resilience
+import settings
+import sinks
+import state_store
+import table_layout
+import windows
+
+logger = logging.getLogger()
+
+# windows loaded at once, across all accounts
+backfill_workers = int(os.getenv("BACKFILL_WORKERS", "4"))
+# stop starting new windows after this many seconds, 0 for no limit.  Set it below the
+# function timeout so a backfill that doesn't fit stops cleanly and is picked up again
+backfill_max_seconds = int(os.getenv("BACKFILL_MAX_SECONDS", "0"))
+# bigquery keeps checkpoints in a table next to the destination table, file in a local
+# json file
+checkpoint_store_type = os.getenv("BACKFILL_CHECKPOINT_STORE", "bigquery")
+checkpoint_table_id = os.getenv("BACKFILL_CHECKPOINT_TABLE", "etl_backfill_checkpoints")
+checkpoint_path = os.getenv(
+    "BACKFILL_CHECKPOINT_PATH", "/tmp/backfill_checkpoints.json"
+)
+
+checkpoint_schema = [
+    bigquery.SchemaField("backfill_id", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("account_id", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("since", "DATE", mode="REQUIRED"),
+    bigquery.SchemaField("until", "DATE", mode="REQUIRED"),
+    bigquery.SchemaField("rows", "INTEGER"),
+    bigquery.SchemaField("completed_at", "TIMESTAMP"),
+]
+
+
+# the windows finished by each backfill, kept in a json file
+class FileCheckpointStore:
+    def __init__(self, path):
+        self.file = state_store.JsonFile(path)
+
+    # {(since, until)} of the account's finished windows
+    def completed(self, backfill_id, account_id):
+        windows_done = self.file.read().get(backfill_id, {}).get(account_id, [])
+        return {(window["since"], window["until"]) for window in windows_done}
+
+    def mark(self, backfill_id, account_id, window, rows):
+        with self.file.updating() as stored:
+            account_windows = stored.setdefault(backfill_id, {}).setdefault(
+                account_id, []
+            )
+            account_windows.append(
+                {"since": window["since"], "until": window["until"], "rows": rows}
+            )
+
+    def clear(self, backfill_id):
+        with self.file.updating() as stored:
+            stored.pop(backfill_id, None)
+
+
+# the windows finished by each backfill, one row per window in a bigquery table
+class BigQueryCheckpointStore:
+    def __init__(self, client, table_ref):
+        self.client = client
+        self.table_ref = table_ref
+
+    def query(self, sql_query, **params):
+        types = {"since": "DATE", "until": "DATE", "rows": "INT64"}
+        job_config = bigquery.QueryJobConfig(
+            query_parameters=[
+                bigquery.ScalarQueryParameter(name, types.get(name, "STRING"), value)
+                for name, value in params.items()
+            ]
+        )
+        query_job = table_layout.query(self.client, sql_query, job_config)
+        rows = list(query_job.result())
+        metrics.increment("bq_bytes_scanned", query_job.total_bytes_processed or 0)
+        return rows
+
+    def completed(self, backfill_id, account_id):
+        sql_query = f"""
+            select since, until
+            FROM `{self.table_ref}`
+            where backfill_id = @backfill_id and account_id = @account_id
+        """
+        try:
+            rows = self.query(sql_query, backfill_id=backfill_id, account_id=account_id)
+        except NotFound:
+            return set()
+        return {(row[0].isoformat(), row[1].isoformat()) for row in rows}
+
+    def mark(self, backfill_id, account_id, window, rows):
+        table = bigquery.Table(self.table_ref, schema=checkpoint_schema)
+        self.client.create_table(table, exists_ok=True)
+        sql_query = f"""
+            insert into `{self.table_ref}`
+                (backfill_id, account_id, since, until, rows, completed_at)
+            values
+                (@backfill_id, @account_id, @since, @until, @rows, current_timestamp())
+        """
+        self.query(
+            sql_query,
+            backfill_id=backfill_id,
+            account_id=account_id,
+            since=datetime.date.fromisoformat(window["since"]),
+            until=datetime.date.fromisoformat(window["until"]),
+            rows=rows,
+        )
+
+    def clear(self, backfill_id):
+        sql_query = f"""
+            delete from `{self.table_ref}` where backfill_id = @backfill_id
+        """
+        try:
+            self.query(sql_query, backfill_id=backfill_id)
+        except NotFound:
+            pass
+
+
+def get_checkpoint_store(client, project_id, dataset_id):
+    if checkpoint_store_type == "file":
+        return FileCheckpointStore(checkpoint_path)
+    table_ref = "{}.{}.{}".format(project_id, dataset_id, checkpoint_table_id)
+    return BigQueryCheckpointStore(client, table_ref)
+
+
+# load one window of one account with its own run metrics.  Windows are loaded with the
+# replace write mode (unless merge is configured) so one that died after loading but
+# before its checkpoint can safely be loaded again
+def load_window(bigquery_client, executor, account_id, window):
+    metrics.reset()
+    resilience.reset_budget()
+    write_mode = "merge" if sinks.bigquery_write_mode == "merge" else "replace"
+    source = facebook.get_source(account_id, bigquery_client, executor)
+    sink = facebook.get_sink(
+        bigquery_client, account_id, since=window["since"], write_mode=write_mode
+    )
+    rows, _ = facebook.run_etl(source, sink, [window])
+    metrics.emit(event="backfill_window", account_id=account_id, window=window)
+    return rows
+
+
+# load every window from since to until of every account that the backfill hasn't
+# finished yet.  Returns a summary, raises once every window was attempted if any failed
+def run_backfill(
+    account_ids,
+    since,
+    until,
+    backfill_id=None,
+    restart=False,
+    workers=None,
+    max_seconds=None,
+):
+    workers = workers or backfill_workers
+    if max_seconds is None:
+        max_seconds = backfill_max_seconds
+    deadline = time.monotonic() + max_seconds if max_seconds else None
+    backfill_id = backfill_id or "{}_{}".format(since, until)
+
+    settings.init_logging()
+    bigquery_client = clients.bigquery_client()
+    facebook.ensure_destination_table(bigquery_client)
+    store = get_checkpoint_store(
+        bigquery_client,
+        facebook.attributes["gcp_project_id"],
+        facebook.attributes["dataset_id"],
+    )
+    if restart:
+        store.clear(backfill_id)
+
+    planned = windows.plan_windows(windows.days_between(since, until))
+    tasks = []
+    for account_id in account_ids:
+        account_id = "act_" + account_id
+        done = store.completed(backfill_id, account_id)
+        for window in planned:
+            if (window["since"], window["until"]) not in done:
+                tasks.append((account_id, window))
+    logger.info(
+        "Backfill {}: {} of {} windows left".format(
+            backfill_id, len(tasks), len(planned) * len(account_ids)
+        )
+    )
+
+    # one executor so every window draws on the same rate limit
+    executor = fetch_executor.FetchExecutor()
+
+    def run_task(task):
+        if deadline is not None and time.monotonic() > deadline:
+            return None
+        account_id, window = task
+        rows = load_window(bigquery_client, executor, account_id, window)
+        store.mark(backfill_id, account_id, window, rows)
+        return rows
+
+    summary = {"backfill_id": backfill_id, "windows": len(tasks), "completed": 0}
+    summary.update({"skipped": 0, "rows": 0, "failed": []})
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [
+            (task, pool.submit(contextvars.copy_context().run, run_task, task))
+            for task in tasks
+        ]
+        for (account_id, window), future in futures:
+            try:
+                rows = future.result()
+            except Exception:
+                logger.exception("Backfill failed for {} {}".format(account_id, window))
+                summary["failed"].append([account_id, window])
+                continue
+            if rows is None:
+                summary["skipped"] = summary["skipped"] + 1
+                continue
+            summary["completed"] = summary["completed"] + 1
+            summary["rows"] = summary["rows"] + rows
+
+    logger.info("Backfill finished", extra={"json_fields": summary})
+    if summary["skipped"]:
+        logger.warning(
+            "Backfill {} ran out of time, run it again to load the {} windows "
+            "left".format(backfill_id, summary["skipped"])
+        )
+    if summary["failed"]:
+        raise RuntimeError(
+            "Backfill {} failed for {} windows".format(
+                backfill_id, len(summary["failed"])
+            )
+        )
+    return summary
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Reload facebook insights")
+    parser.add_argument("--since", required=True, type=datetime.date.fromisoformat)
+    parser.add_argument("--until", required=True, type=datetime.date.fromisoformat)
+    parser.add_argument(
+        "--accounts", help="comma separated, every configured account by default"
+    )
+    parser.add_argument("--id", help="checkpoint name, since_until by default")
+    parser.add_argument(
+        "--restart", action="store_true", help="forget the windows already loaded"
+    )
+    parser.add_argument("--workers", type=int)
+    parser.add_argument("--max-seconds", type=int)
+    args = parser.parse_args()
+
+    payload = {"accounts": args.accounts} if args.accounts else {}
+    account_ids = accounts.select_accounts(
+        payload, facebook.attributes["fb_account_id"]
+    )
+    summary = run_backfill(
+        account_ids,
+        args.since,
+        args.until,
+        backfill_id=args.id,
+        restart=args.restart,
+        workers=args.workers,
+        max_seconds=args.max_seconds,
+    )
+    print(json.dumps(summary, indent=2))
+
+
+if __name__ == "__main__":
+    main()
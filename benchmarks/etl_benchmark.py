@@ -0,0 +1,264 @@
+# Runs the etl end to end against a local fake Graph API server and an in-process fake
+# BigQuery client and reports rows/sec, api calls per day of data, peak python memory and
+# the time spent fetching, transforming and loading, for every combination of campaign
+# and day counts.  Use it to catch scaling regressions before deploying.
+#
+# Run from the repo root:
+#   python benchmarks/etl_benchmark.py --campaigns 10,100 --days 1,7,30 --latency 0.02
+#   python benchmarks/etl_benchmark.py --extract --campaigns 10,50
+import argparse
+import contextlib
+import datetime
+import io
+import os
+import runpy
+import sys
+import time
+import tracemalloc
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+import fake_bigquery  # noqa: E402
+import fake_graph  # noqa: E402
+import gspread  # noqa: E402
+from facebook_business.adobjects.adaccount import AdAccount  # noqa: E402
+from facebook_business.api import FacebookAdsApi  # noqa: E402
+from facebook_business.session import FacebookSession  # noqa: E402
+
+import async_reports  # noqa: E402
+import campaign_store  # noqa: E402
+import facebook  # noqa: E402
+import graph_cache  # noqa: E402
+import sinks  # noqa: E402
+import windows  # noqa: E402
+
+
+# adds up the time spent waiting on a source, which is the fetch stage
+class TimedSource:
+    def __init__(self, source):
+        self.source = source
+        self.seconds = 0.0
+
+    def get_campaign_index(self):
+        start = time.perf_counter()
+        index = self.source.get_campaign_index()
+        self.seconds = self.seconds + time.perf_counter() - start
+        return index
+
+    def fetch_insights(self, time_ranges):
+        yield from self.timed(
+            (timerange, self.timed(rows))
+            for timerange, rows in self.source.fetch_insights(time_ranges)
+        )
+
+    def timed(self, items):
+        items = iter(items)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(items)
+            except StopIteration:
+                self.seconds = self.seconds + time.perf_counter() - start
+                return
+            self.seconds = self.seconds + time.perf_counter() - start
+            yield item
+
+
+# adds up the time spent in a sink, which is the load stage
+class TimedSink:
+    def __init__(self, sink):
+        self.sink = sink
+        self.seconds = 0.0
+
+    def write(self, rows):
+        start = time.perf_counter()
+        self.sink.write(rows)
+        self.seconds = self.seconds + time.perf_counter() - start
+
+    def close(self):
+        start = time.perf_counter()
+        rows = self.sink.close()
+        self.seconds = self.seconds + time.perf_counter() - start
+        return rows
+
+
+class FakeWorksheet:
+    def __init__(self):
+        self.values = []
+        self.update_calls = 0
+        self.cells_written = 0
+
+    def batch_update(self, data, **kwargs):
+        self.update_calls = self.update_calls + 1
+        for update in data:
+            first = update["range"].split(":")[0]
+            start = int("".join(c for c in first if c.isdigit())) - 1
+            for offset, row in enumerate(update["values"]):
+                while len(self.values) <= start + offset:
+                    self.values.append([])
+                self.values[start + offset] = list(row)
+                self.cells_written = self.cells_written + len(row)
+        while self.values and not any(self.values[-1]):
+            self.values.pop()
+
+    def get_all_values(self):
+        return self.values
+
+
+class FakeSpreadsheet:
+    def __init__(self):
+        self.sheet = FakeWorksheet()
+
+    def open_by_key(self, key):
+        return self
+
+    def worksheet(self, name):
+        return self.sheet
+
+
+def start_graph(campaigns, args):
+    graph = fake_graph.FakeGraph(
+        campaigns=campaigns,
+        latency=args.latency,
+        page_size=args.page_size,
+        usage_per_call=args.usage_per_call,
+    )
+    FacebookSession.GRAPH = graph.start()
+    return graph
+
+
+def run_etl_case(campaigns, days, args):
+    graph = start_graph(campaigns, args)
+    graph_cache.install(FacebookAdsApi.init("app_id", "app_secret", "access_token"))
+    campaign_store.campaign_cache_ttl = 0
+    async_reports.use_async_reports = args.use_async
+    async_reports.poll_interval = 0.01
+
+    client = fake_bigquery.FakeBigQueryClient(schema=facebook.fb_source_schema)
+    sink = TimedSink(
+        sinks.BigQuerySink(
+            client, "bench.dataset.table", mode=args.sink, write_mode=args.write_mode
+        )
+    )
+    source = TimedSource(facebook.GraphSource(AdAccount(fake_graph.account_id)))
+    last_day = datetime.date.today() - datetime.timedelta(days=1)
+    time_ranges = windows.plan_windows(
+        windows.days_between(last_day - datetime.timedelta(days=days - 1), last_day)
+    )
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    rows, _ = facebook.run_etl(source, sink, time_ranges)
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    graph.stop()
+
+    return {
+        "campaigns": campaigns,
+        "days": days,
+        "rows": rows,
+        "seconds": seconds,
+        "api_calls": graph.total_calls(),
+        "peak_mb": peak / 1024 / 1024,
+        "fetch": source.seconds,
+        "transform": seconds - source.seconds - sink.seconds,
+        "load": sink.seconds,
+        "bq_bytes": client.bytes_sent,
+    }
+
+
+def run_extract_case(campaigns, args):
+    graph = start_graph(campaigns, args)
+    spreadsheet = FakeSpreadsheet()
+    gspread.service_account = lambda filename=None: spreadsheet
+    os.environ.update(
+        {
+            "account_id": fake_graph.account_id,
+            "app_id": "app_id",
+            "app_secret": "app_secret",
+            "access_token": "access_token",
+            "google_sheets_credentials": "credentials.json",
+            "google_sheets_spreadsheet_id": "spreadsheet",
+            "google_sheets_worksheet_name": "worksheet",
+        }
+    )
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    with contextlib.redirect_stdout(io.StringIO()):
+        runpy.run_path(os.path.join(repo_dir, "facebook-marketing-extract.py"))
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    graph.stop()
+
+    rows = max(0, len(spreadsheet.sheet.values) - 1)
+    return {
+        "campaigns": campaigns,
+        "days": 1,
+        "rows": rows,
+        "seconds": seconds,
+        "api_calls": graph.total_calls(),
+        "peak_mb": peak / 1024 / 1024,
+        "fetch": None,
+        "transform": None,
+        "load": None,
+        "bq_bytes": None,
+    }
+
+
+def print_results(results):
+    columns = [
+        ("campaigns", "{}"),
+        ("days", "{}"),
+        ("rows", "{}"),
+        ("seconds", "{:.2f}"),
+        ("rows/s", "{:.0f}"),
+        ("api_calls", "{}"),
+        ("calls/day", "{:.1f}"),
+        ("peak_mb", "{:.1f}"),
+        ("fetch", "{:.2f}"),
+        ("transform", "{:.2f}"),
+        ("load", "{:.2f}"),
+        ("bq_bytes", "{}"),
+    ]
+    print("  ".join("{:>10}".format(name) for name, _ in columns))
+    for result in results:
+        result["rows/s"] = result["rows"] / result["seconds"]
+        result["calls/day"] = result["api_calls"] / result["days"]
+        cells = []
+        for name, format_string in columns:
+            value = result[name]
+            cells.append("-" if value is None else format_string.format(value))
+        print("  ".join("{:>10}".format(cell) for cell in cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--campaigns", default="10,100")
+    parser.add_argument("--days", default="1,7,30")
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--page-size", type=int, default=None)
+    parser.add_argument("--usage-per-call", type=float, default=0.0)
+    parser.add_argument("--async", dest="use_async", action="store_true")
+    parser.add_argument("--sink", default="load")
+    parser.add_argument("--write-mode", default="append")
+    parser.add_argument("--extract", action="store_true")
+    args = parser.parse_args()
+
+    campaign_counts = [int(count) for count in args.campaigns.split(",")]
+    day_counts = [int(count) for count in args.days.split(",")]
+    results = []
+    for campaigns in campaign_counts:
+        if args.extract:
+            results.append(run_extract_case(campaigns, args))
+            continue
+        for days in day_counts:
+            results.append(run_etl_case(campaigns, days, args))
+    print_results(results)
+
+
+if __name__ == "__main__":
+    main()
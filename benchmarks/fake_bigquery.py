@@ -0,0 +1,80 @@
+# An in-process stand-in for the google.cloud.bigquery Client methods the etl calls.  It
+# keeps no data, it counts rows, bytes, load jobs and queries so benchmarks can report
+# what a run would have sent to BigQuery.
+import gzip
+import io
+import json
+import threading
+
+from google.cloud import bigquery
+
+
+class FakeJob:
+    def __init__(self, rows=None):
+        self.rows = rows or []
+        self.total_bytes_processed = 0
+
+    def result(self):
+        return iter(self.rows)
+
+
+class FakeBigQueryClient:
+    def __init__(self, schema=None, query_results=None):
+        self.schema = schema or []
+        # substring of a query -> rows it returns, e.g. {"max(": [(None,)]}
+        self.query_results = query_results or {}
+        self.rows_streamed = 0
+        self.rows_loaded = 0
+        self.bytes_sent = 0
+        self.insert_calls = 0
+        self.load_jobs = 0
+        self.queries = []
+        self.dry_runs = 0
+        self.tables = set()
+        self.lock = threading.Lock()
+
+    def get_table(self, table_ref):
+        return bigquery.Table(table_ref, schema=self.schema)
+
+    def create_table(self, table, exists_ok=False):
+        self.tables.add(table.table_id)
+        return table
+
+    def delete_table(self, table_ref, not_found_ok=False):
+        self.tables.discard(str(table_ref).split(".")[-1])
+
+    def insert_rows_json(self, json_rows, table, **kwargs):
+        with self.lock:
+            self.insert_calls = self.insert_calls + 1
+            self.rows_streamed = self.rows_streamed + len(json_rows)
+            self.bytes_sent = self.bytes_sent + len(json.dumps(json_rows))
+        return []
+
+    def load_table_from_file(self, file_obj, destination, job_config=None, **kwargs):
+        data = file_obj.read()
+        with self.lock:
+            self.load_jobs = self.load_jobs + 1
+            self.bytes_sent = self.bytes_sent + len(data)
+            if data[:2] == b"\x1f\x8b":
+                data = gzip.decompress(data)
+            if data[:4] == b"PAR1":
+                import pyarrow.parquet as pq
+
+                self.rows_loaded = (
+                    self.rows_loaded + pq.read_metadata(io.BytesIO(data)).num_rows
+                )
+            else:
+                self.rows_loaded = self.rows_loaded + data.count(b"\n")
+        return FakeJob()
+
+    def query(self, sql_query, job_config=None, **kwargs):
+        if job_config is not None and job_config.dry_run:
+            with self.lock:
+                self.dry_runs = self.dry_runs + 1
+            return FakeJob()
+        with self.lock:
+            self.queries.append(sql_query)
+        for match, rows in self.query_results.items():
+            if match in sql_query:
+                return FakeJob(rows)
+        return FakeJob()
@@ -0,0 +1,270 @@
+# A local stand-in for the parts of the Graph API the etl uses: account campaigns,
+# adsets and insights (sync and async report runs) plus adset insights, on their own or
+# in batch calls.  Responses are
+# paginated like the real api, can be slowed down with a fixed latency and carry
+# x-business-use-case-usage headers that rise with the call rate.  Data is generated
+# deterministically from the campaign count so runs are comparable.
+import datetime
+import hashlib
+import json
+import threading
+import time
+import urllib.parse
+from collections import Counter, deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+account_id = "act_1000"
+business_id = "2000"
+
+
+def stable_number(*parts, modulo=1000):
+    digest = hashlib.md5("/".join(str(part) for part in parts).encode()).hexdigest()
+    return int(digest[:8], 16) % modulo
+
+
+def parse_day(value):
+    return datetime.date.fromisoformat(value)
+
+
+class FakeGraph:
+    def __init__(
+        self,
+        campaigns=50,
+        adsets_per_campaign=2,
+        latency=0.0,
+        page_size=None,
+        usage_per_call=0.0,
+        throttle=False,
+    ):
+        self.campaign_ids = [str(1200000000 + i) for i in range(campaigns)]
+        self.adset_campaigns = {}
+        for campaign_id in self.campaign_ids:
+            for i in range(adsets_per_campaign):
+                self.adset_campaigns[campaign_id + "0" + str(i)] = campaign_id
+        self.latency = latency
+        self.page_size = page_size
+        # percent of the business use case quota each call in the last minute uses
+        self.usage_per_call = usage_per_call
+        self.throttle = throttle
+        self.calls = Counter()
+        self.recent_calls = deque()
+        self.reports = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    def start(self):
+        graph = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.respond("GET")
+
+            def do_POST(self):
+                self.respond("POST")
+
+            def respond(self, method):
+                url = urllib.parse.urlsplit(self.path)
+                params = dict(urllib.parse.parse_qsl(url.query))
+                length = int(self.headers.get("Content-Length") or 0)
+                if length:
+                    body = self.rfile.read(length).decode()
+                    params.update(urllib.parse.parse_qsl(body))
+                status, payload, headers = graph.handle(method, url.path, params)
+                data = json.dumps(payload).encode()
+                self.send_response(status)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                for name, value in headers.items():
+                    self.send_header(name, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.server.daemon_threads = True
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        return "http://127.0.0.1:{}".format(self.server.server_address[1])
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def total_calls(self):
+        return sum(self.calls.values())
+
+    def usage(self):
+        now = time.monotonic()
+        with self.lock:
+            self.recent_calls.append(now)
+            while self.recent_calls and self.recent_calls[0] < now - 60:
+                self.recent_calls.popleft()
+            return min(100, int(len(self.recent_calls) * self.usage_per_call))
+
+    def handle(self, method, path, params):
+        if self.latency:
+            time.sleep(self.latency)
+        # drop the /vXX.X version prefix
+        parts = [part for part in path.split("/") if part][1:]
+        usage = self.usage()
+        headers = {
+            "x-business-use-case-usage": json.dumps(
+                {
+                    business_id: [
+                        {
+                            "type": "ads_insights",
+                            "call_count": usage,
+                            "total_cputime": usage // 2,
+                            "total_time": usage // 2,
+                            "estimated_time_to_regain_access": 0,
+                        }
+                    ]
+                }
+            )
+        }
+        with self.lock:
+            self.calls["/".join(["{node}"] + parts[1:]) + " " + method] += 1
+        if self.throttle and usage >= 100:
+            error = {"error": {"code": 80000, "message": "Too many calls"}}
+            return 400, error, headers
+
+        if not parts and "batch" in params:
+            return 200, self.batch(json.loads(params["batch"])), headers
+        return self.route(method, parts, params, path) + (headers,)
+
+    # answer each request of a batch call as if it had been sent on its own
+    def batch(self, calls):
+        responses = []
+        for call in calls:
+            url = urllib.parse.urlsplit("/" + call["relative_url"])
+            params = dict(urllib.parse.parse_qsl(url.query))
+            params.update(urllib.parse.parse_qsl(call.get("body", "")))
+            parts = [part for part in url.path.split("/") if part]
+            status, payload = self.route(call["method"], parts, params, url.path)
+            responses.append(
+                {"code": status, "headers": [], "body": json.dumps(payload)}
+            )
+        return responses
+
+    def route(self, method, parts, params, path):
+        node = parts[0] if parts else ""
+        edge = parts[1] if len(parts) > 1 else ""
+        if node == account_id and edge == "campaigns":
+            return 200, self.page(self.campaign_rows(), params, path)
+        if node == account_id and edge == "adsets":
+            return 200, self.page(self.adset_rows(), params, path)
+        if node == account_id and edge == "insights" and method == "POST":
+            report_id = str(9000000 + len(self.reports))
+            self.reports[report_id] = params
+            return 200, {"report_run_id": report_id}
+        if node == account_id and edge == "insights":
+            return 200, self.page(self.insight_rows(params), params, path)
+        if node in self.reports and edge == "insights":
+            rows = self.insight_rows(self.reports[node])
+            return 200, self.page(rows, params, path)
+        if node in self.reports:
+            report = {
+                "id": node,
+                "async_status": "Job Completed",
+                "async_percent_completion": 100,
+            }
+            return 200, report
+        if node in self.adset_campaigns and edge == "insights":
+            rows = self.insight_rows(params, adset_ids=[node])
+            return 200, self.page(rows, params, path)
+        error = {"error": {"code": 100, "message": "Unknown path " + path}}
+        return 400, error
+
+    def page(self, rows, params, path):
+        limit = int(params.get("limit", 25))
+        if self.page_size:
+            limit = min(limit, self.page_size)
+        offset = int(params.get("after", 0))
+        response = {
+            "data": rows[offset : offset + limit],
+            "paging": {"cursors": {"after": str(offset + limit)}},
+        }
+        if offset + limit < len(rows):
+            response["paging"]["next"] = path + "?after=" + str(offset + limit)
+        return response
+
+    def campaign_rows(self):
+        return [
+            {
+                "id": campaign_id,
+                "name": "Campaign " + campaign_id,
+                "created_time": "2024-01-01T00:00:00+0000",
+                "start_time": "2024-01-02T00:00:00+0000",
+                "status": "ACTIVE",
+                "objective": "APP_INSTALLS",
+            }
+            for campaign_id in self.campaign_ids
+        ]
+
+    def adset_rows(self):
+        return [
+            {"id": adset_id, "status": "ACTIVE", "campaign_id": campaign_id}
+            for adset_id, campaign_id in self.adset_campaigns.items()
+        ]
+
+    def insight_rows(self, params, adset_ids=None):
+        if "time_range" in params:
+            time_range = json.loads(params["time_range"])
+            since = parse_day(time_range["since"])
+            until = parse_day(time_range["until"])
+        else:
+            until = datetime.date.today()
+            since = until - datetime.timedelta(days=29)
+        if params.get("time_increment") in ("1", 1):
+            days = [
+                (since + datetime.timedelta(days=i),) * 2
+                for i in range((until - since).days + 1)
+            ]
+        else:
+            days = [(since, until)]
+
+        level = params.get("level", "campaign")
+        if adset_ids is not None or level in ("adset", "ad"):
+            entities = [
+                (adset_id, self.adset_campaigns[adset_id])
+                for adset_id in (adset_ids or self.adset_campaigns)
+            ]
+        else:
+            entities = [(None, campaign_id) for campaign_id in self.campaign_ids]
+
+        rows = []
+        for day_start, day_stop in days:
+            for adset_id, campaign_id in entities:
+                key = adset_id or campaign_id
+                impressions = stable_number(key, day_start, modulo=100000) + 100
+                clicks = stable_number(key, day_start, "clicks", modulo=impressions)
+                spend = stable_number(key, day_start, "spend", modulo=50000) / 100
+                installs = stable_number(key, day_start, "installs", modulo=200)
+                row = {
+                    "account_id": account_id[4:],
+                    "campaign_id": campaign_id,
+                    "campaign_name": "Campaign " + campaign_id,
+                    "date_start": day_start.isoformat(),
+                    "date_stop": day_stop.isoformat(),
+                    "impressions": str(impressions),
+                    "reach": str(impressions * 9 // 10),
+                    "clicks": str(clicks),
+                    "spend": "{:.2f}".format(spend),
+                    "cpc": "{:.6f}".format(spend / clicks) if clicks else "0",
+                    "cpm": "{:.6f}".format(spend * 1000 / impressions),
+                    "ctr": "{:.6f}".format(clicks * 100 / impressions),
+                    "objective": "APP_INSTALLS",
+                    "actions": [
+                        {"action_type": "mobile_app_install", "value": str(installs)},
+                        {"action_type": "link_click", "value": str(clicks)},
+                    ],
+                }
+                if installs % 3 == 0:
+                    row["conversions"] = [
+                        {"action_type": "app_custom_event", "value": str(installs // 3)}
+                    ]
+                if adset_id is not None:
+                    row["adset_id"] = adset_id
+                rows.append(row)
+        return rows
@@ -0,0 +1,115 @@
+# Runs the etl from a small in-memory fixture into the ndjson and parquet file sinks with
+# both the columnar and the row transform, and reads every file back.  Exits non zero when
+# a combination fails, writes the wrong rows, or doesn't reject a row that doesn't parse.
+#
+# Run from the repo root: python benchmarks/sink_check.py
+import gzip
+import json
+import os
+import sys
+import tempfile
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, repo_dir)
+
+import pyarrow as pa  # noqa: E402
+import pyarrow.parquet as pq  # noqa: E402
+
+import columnar  # noqa: E402
+import facebook  # noqa: E402
+import sinks  # noqa: E402
+import sources  # noqa: E402
+
+time_ranges = [{"since": "2024-01-01", "until": "2024-01-02"}]
+
+
+def insight(day, campaign_id, clicks):
+    return {
+        "date_start": day,
+        "campaign_id": campaign_id,
+        "campaign_name": "campaign " + campaign_id,
+        "clicks": clicks,
+        "impressions": "100",
+        "reach": "80",
+        "cpc": "0.25",
+        "spend": "1.5",
+        "actions": [{"action_type": "mobile_app_install", "value": "2"}],
+    }
+
+
+def fixture(bad_row=False):
+    insights = [insight("2024-01-01", "1", "4"), insight("2024-01-02", "1", "5")]
+    if bad_row:
+        insights.append(insight("2024-01-02", "2", "not a number"))
+    campaigns = {"1": {"id": "1", "status": "ACTIVE"}, "2": {"id": "2"}}
+    return sources.FixtureSource(fixture={"campaigns": campaigns, "insights": insights})
+
+
+def read_back(sink_type, path):
+    if sink_type == "parquet":
+        table = pq.read_table(path)
+        if table.schema.field("date_inserted").type != pa.timestamp("us", tz="UTC"):
+            raise AssertionError("date_inserted is not a UTC timestamp")
+        return table.to_pylist()
+    with gzip.open(path, "rt") as f:
+        return [json.loads(line) for line in f]
+
+
+def make_sink(sink_type, path):
+    if sink_type == "parquet":
+        return sinks.ParquetFileSink(path, facebook.fb_source_schema)
+    return sinks.NdjsonFileSink(path)
+
+
+# runs one combination, returns what went wrong or None
+def check(sink_type, use_columnar, directory):
+    columnar.use_columnar = use_columnar
+    path = os.path.join(directory, "rows." + sink_type)
+    if sink_type == "ndjson":
+        path = path + ".gz"
+    rows, last_day = facebook.run_etl(
+        fixture(), make_sink(sink_type, path), time_ranges
+    )
+    written = read_back(sink_type, path)
+    if rows != 2 or len(written) != 2:
+        return "wrote {} rows, read back {}, expected 2".format(rows, len(written))
+    if str(last_day) != "2024-01-02":
+        return "last day {}".format(last_day)
+    if [int(row["clicks"]) for row in written] != [4, 5]:
+        return "clicks {}".format([row["clicks"] for row in written])
+
+    if use_columnar:
+        try:
+            facebook.run_etl(
+                fixture(bad_row=True), make_sink(sink_type, path), time_ranges
+            )
+        except sinks.RejectedRowsError:
+            if len(read_back(sink_type, path)) != 2:
+                return "rows that parse were not written next to a rejected row"
+        else:
+            return "a row that doesn't parse was not rejected"
+    return None
+
+
+def main():
+    failed = False
+    with tempfile.TemporaryDirectory() as directory:
+        for sink_type in ["ndjson", "parquet"]:
+            for use_columnar in [True, False]:
+                transform = "columnar" if use_columnar else "row"
+                try:
+                    problem = check(sink_type, use_columnar, directory)
+                except Exception as e:
+                    problem = "{}: {}".format(type(e).__name__, e)
+                print(
+                    "{} sink, {} transform: {}".format(
+                        sink_type, transform, problem or "ok"
+                    )
+                )
+                failed = failed or problem is not None
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,58 @@
+# Measures how long importing main takes in a fresh interpreter, which is the part of a
+# cloud function cold start that happens before import_data runs.  Exits non zero when
+# the median import time is over budget or when importing fetches secrets.
+#
+# Run from the repo root: python benchmarks/startup.py
+import os
+import statistics
+import subprocess
+import sys
+
+repo_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+budget_ms = float(os.getenv("STARTUP_BUDGET_MS", "2500"))
+runs = int(os.getenv("STARTUP_RUNS", "5"))
+
+probe = """
+import time
+start = time.perf_counter()
+import settings
+
+
+def fail():
+    raise RuntimeError("secrets were fetched while importing main")
+
+
+settings.load_secrets = fail
+import main
+print((time.perf_counter() - start) * 1000)
+"""
+
+
+def measure_import():
+    result = subprocess.run(
+        [sys.executable, "-c", probe],
+        cwd=repo_dir,
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        print(result.stderr)
+        sys.exit(1)
+    return float(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    timings = [measure_import() for run in range(runs)]
+    median = statistics.median(timings)
+    print(
+        "import main: median {:.0f}ms, min {:.0f}ms, max {:.0f}ms over {} runs".format(
+            median, min(timings), max(timings), runs
+        )
+    )
+    if median > budget_ms:
+        print("over the {:.0f}ms startup budget".format(budget_ms))
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
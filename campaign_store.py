@@ -0,0 +1,184 @@
+import json
+import os
+import threading
+import time
+
+from google.cloud import bigquery
+
+import metrics
+import resilience
+import state_store
+
+# campaign snapshots keyed by account id -> {"loaded_at", "full_at", "campaigns"}.
+# Module level so warm cloud function instances can reuse the last pull
+_campaign_indexes = {}
+
+# seconds a campaign index is used without asking the api for changes, 0 always asks
+campaign_cache_ttl = int(os.getenv("CAMPAIGN_CACHE_TTL", "3600"))
+# optional json file to persist the index, e.g. /tmp/campaigns.json on a cloud function
+campaign_cache_path = os.getenv("CAMPAIGN_CACHE_PATH", "")
+# where snapshots outlive the instance: file (CAMPAIGN_CACHE_PATH) or bigquery, a table
+# in the destination dataset
+campaign_store_type = os.getenv("CAMPAIGN_STORE", "file")
+campaign_table_id = os.getenv("CAMPAIGN_TABLE", "etl_campaigns")
+# hours between full pulls of every campaign, in between only campaigns updated since
+# the last sync are fetched
+full_refresh_hours = float(os.getenv("CAMPAIGN_FULL_REFRESH_HOURS", "24"))
+# a delta sync asks for changes since a little before the last one started
+sync_overlap_seconds = 300
+
+campaign_schema = [
+    bigquery.SchemaField("account_id", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("loaded_at", "FLOAT", mode="REQUIRED"),
+    bigquery.SchemaField("full_at", "FLOAT", mode="REQUIRED"),
+    bigquery.SchemaField("campaigns", "STRING", mode="REQUIRED"),
+]
+
+
+# turn a campaigns cursor into a dict keyed by campaign id.  Iterating the cursor pages
+# through it once instead of random indexing which can trigger page fetches
+def build_campaign_index(campaigns):
+    index = {}
+    for campaign in campaigns:
+        if hasattr(campaign, "export_all_data"):
+            campaign = campaign.export_all_data()
+        index[campaign.get("id")] = dict(campaign)
+    return index
+
+
+# campaign snapshots kept in a json file, or only in memory without a path
+class FileCampaignStore:
+    def __init__(self, path):
+        self.file = state_store.JsonFile(path)
+
+    def read(self, account_id):
+        snapshot = self.file.read().get(account_id)
+        if snapshot is not None:
+            # files written before full refreshes were tracked
+            snapshot.setdefault("full_at", snapshot["loaded_at"])
+        return snapshot
+
+    def write(self, account_id, snapshot):
+        with self.file.updating() as stored:
+            stored[account_id] = snapshot
+
+
+# campaign snapshots kept in a bigquery table, one row per account with the campaigns as
+# json so reading one is a single small query
+class BigQueryCampaignStore:
+    def __init__(self, client, table_ref):
+        self.rows = state_store.BigQueryRowStore(
+            client, table_ref, campaign_schema, ["account_id"]
+        )
+
+    def read(self, account_id):
+        row = self.rows.get(account_id=account_id)
+        if row is None:
+            return None
+        row["campaigns"] = json.loads(row["campaigns"])
+        return row
+
+    def write(self, account_id, snapshot):
+        self.rows.put(
+            account_id=account_id,
+            loaded_at=snapshot["loaded_at"],
+            full_at=snapshot["full_at"],
+            campaigns=json.dumps(snapshot["campaigns"]),
+        )
+
+
+def get_snapshot_store(client=None, project_id=None, dataset_id=None):
+    if campaign_store_type == "bigquery" and client is not None:
+        table_ref = "{}.{}.{}".format(project_id, dataset_id, campaign_table_id)
+        return BigQueryCampaignStore(client, table_ref)
+    return FileCampaignStore(campaign_cache_path)
+
+
+# the campaigns changed since timestamp, campaigns_query_params without the date preset
+# and with an updated_time filter
+def fetch_updated_campaigns(account, fields, params, since):
+    delta_params = {key: value for key, value in params.items() if key != "date_preset"}
+    delta_params["filtering"] = [
+        {"field": "updated_time", "operator": "GREATER_THAN", "value": int(since)}
+    ]
+    campaigns = resilience.call("graph", account.get_campaigns, fields, delta_params)
+    return build_campaign_index(resilience.iter_retrying("graph", campaigns))
+
+
+# the snapshot brought up to date with the campaigns updated since it was taken
+def sync_snapshot(account, fields, params, snapshot, started):
+    since = snapshot["loaded_at"] - sync_overlap_seconds
+    updated = fetch_updated_campaigns(account, fields, params, since)
+    metrics.increment("campaigns_updated", len(updated))
+    index = dict(snapshot["campaigns"])
+    index.update(updated)
+    return {"loaded_at": started, "full_at": snapshot["full_at"], "campaigns": index}
+
+
+# a campaign index read from a snapshot.  The first lookup of a campaign that isn't in it
+# runs sync once, a campaign created since the snapshot was taken is then found without
+# waiting for the ttl to run out
+class CampaignIndex(dict):
+    def __init__(self, campaigns, sync=None):
+        super().__init__(campaigns)
+        self.sync = sync
+        self.lock = threading.Lock()
+
+    def refresh(self):
+        with self.lock:
+            sync, self.sync = self.sync, None
+            if sync is not None:
+                self.update(sync())
+
+
+# get the campaign dimension for an account.  A snapshot younger than ttl seconds is used
+# as it is, an older one is brought up to date with the campaigns updated since it was
+# taken, and every CAMPAIGN_FULL_REFRESH_HOURS the whole list is pulled again
+def get_campaign_index(account, fields, params, ttl=None, path=None, store=None):
+    if ttl is None:
+        ttl = campaign_cache_ttl
+    if store is None:
+        store = FileCampaignStore(campaign_cache_path if path is None else path)
+    account_id = account.get_id()
+
+    snapshot = _campaign_indexes.get(account_id)
+    if snapshot is None:
+        snapshot = store.read(account_id)
+    started = time.time()
+    if snapshot is not None and started - snapshot["loaded_at"] < ttl:
+        _campaign_indexes[account_id] = snapshot
+
+        def sync_missing():
+            metrics.increment("campaign_miss_syncs")
+            synced = sync_snapshot(account, fields, params, snapshot, time.time())
+            _campaign_indexes[account_id] = synced
+            store.write(account_id, synced)
+            return synced["campaigns"]
+
+        return CampaignIndex(snapshot["campaigns"], sync_missing)
+
+    if (
+        snapshot is not None
+        and started - snapshot["full_at"] < full_refresh_hours * 3600
+    ):
+        snapshot = sync_snapshot(account, fields, params, snapshot, started)
+    else:
+        campaigns = resilience.call("graph", account.get_campaigns, fields, params)
+        index = build_campaign_index(resilience.iter_retrying("graph", campaigns))
+        metrics.increment("campaigns_full_refresh")
+        snapshot = {"loaded_at": started, "full_at": started, "campaigns": index}
+
+    _campaign_indexes[account_id] = snapshot
+    store.write(account_id, snapshot)
+    return snapshot["campaigns"]
+
+
+# the campaign's fields, {} for a campaign the index doesn't have even after a sync
+def lookup_campaign(campaign_id, campaign_index):
+    campaign = campaign_index.get(campaign_id)
+    if campaign is None and isinstance(campaign_index, CampaignIndex):
+        campaign_index.refresh()
+        campaign = campaign_index.get(campaign_id)
+    if campaign is None:
+        return {}
+    return campaign
@@ -0,0 +1,93 @@
+import logging
+import os
+import threading
+
+from facebook_business.api import FacebookAdsApi
+from google.cloud import bigquery
+from requests.adapters import HTTPAdapter
+
+import accounts
+import fetch_executor
+import graph_cache
+
+logger = logging.getLogger()
+
+# connections kept open per host by each client.  Every account fetches with its own
+# FETCH_WORKERS threads and loads at the same time, so by default there is one for each
+# request that can be in flight at once
+pool_size = int(
+    os.getenv(
+        "CLIENT_POOL_SIZE",
+        str(max(10, accounts.account_workers * fetch_executor.max_fetch_workers)),
+    )
+)
+
+# Clients for the life of the process.  A warm cloud function instance reuses them, and
+# with them their open connections and access tokens, for every later invocation.  All of
+# them are safe to share between threads
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+# a requests session keeps pool_size open connections per host instead of the default 10
+def mount_pool(session, size=None):
+    size = size or pool_size
+    adapter = HTTPAdapter(pool_connections=size, pool_maxsize=size)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+# the client stored under key, made with make the first time it is asked for
+def get_client(key, make):
+    client = _clients.get(key)
+    if client is not None:
+        return client
+    with _clients_lock:
+        if key not in _clients:
+            _clients[key] = make()
+            logger.debug("Created {} client".format(key[0]))
+        return _clients[key]
+
+
+def bigquery_client():
+    def make():
+        client = bigquery.Client()
+        mount_pool(client._http)
+        return client
+
+    return get_client(("bigquery",), make)
+
+
+def secret_manager_client():
+    def make():
+        # imported here, the grpc client takes a while to import
+        from google.cloud import secretmanager
+
+        return secretmanager.SecretManagerServiceClient()
+
+    return get_client(("secretmanager",), make)
+
+
+# the Ads API session for a set of credentials, made the default api for the process.  A
+# new access token gets a new session, the old one is dropped
+def facebook_api(app_id, app_secret, access_token):
+    key = ("facebook", app_id, app_secret, access_token)
+
+    # runs with the registry locked
+    def make():
+        for old_key in [k for k in _clients if k[0] == "facebook"]:
+            del _clients[old_key]
+        api = FacebookAdsApi.init(app_id, app_secret, access_token)
+        mount_pool(api._session.requests)
+        return graph_cache.install(api)
+
+    api = get_client(key, make)
+    FacebookAdsApi.set_default_api(api)
+    return api
+
+
+# forget every client, the next call for one makes a new one
+def reset():
+    with _clients_lock:
+        _clients.clear()
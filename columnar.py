@@ -0,0 +1,116 @@
+import json
+import logging
+import os
+
+import pyarrow as pa
+
+import campaign_store
+import metrics
+import sources
+
+logger = logging.getLogger()
+
+# transform insights into arrow record batches with typed numeric columns instead of one
+# dict of strings per row.  Set to False to fall back to the row transform
+use_columnar = os.getenv("ETL_COLUMNAR", "True") == "True"
+
+# api fields copied as they are, by destination column
+insight_columns = {
+    "data_date_start": "date_start",
+    "campaign_id": "campaign_id",
+    "campaign_name": "campaign_name",
+    "clicks": "clicks",
+    "impressions": "impressions",
+    "reach": "reach",
+    "cpc": "cpc",
+    "spend": "spend",
+}
+
+# campaign fields by destination column
+campaign_columns = {
+    "created_time": "created_time",
+    "start_time": "start_time",
+    "end_time": "stop_time",
+    "status": "status",
+    "objective": "objective",
+}
+
+# fields missing from an insight row are filled with these
+insight_defaults = {"cpc": "0"}
+
+
+def action_list(values):
+    return [
+        {"action_type": value["action_type"], "value": value["value"]}
+        for value in values or []
+    ]
+
+
+# the indexes of the values that can't be cast from string to data_type
+def unparsable(values, data_type):
+    indexes = []
+    for index, value in enumerate(values):
+        try:
+            pa.scalar(value, pa.string()).cast(data_type)
+        except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+            indexes.append(index)
+    return indexes
+
+
+# the columns cast to the schema types.  Rows with a value that doesn't parse are added
+# to bad, the arrays are only usable when it stays empty
+def build_arrays(columns, schema, date_inserted, count, bad):
+    arrays = []
+    for field in schema:
+        if field.name == "date_inserted":
+            array = pa.repeat(pa.scalar(date_inserted, field.type), count)
+        elif field.name == "location":
+            array = pa.repeat(pa.scalar("deprecated", field.type), count)
+        elif pa.types.is_list(field.type):
+            array = pa.array(columns[field.name], type=field.type)
+        else:
+            array = pa.array(columns[field.name], type=pa.string())
+            try:
+                array = array.cast(field.type)
+            except (pa.ArrowInvalid, pa.ArrowNotImplementedError):
+                bad.update(unparsable(columns[field.name], field.type))
+        arrays.append(array)
+    return arrays
+
+
+# one record batch in the layout of schema for a list of insight rows joined with campaign
+# fields.  Columns are built as lists of api strings in one pass and cast to the schema
+# types in bulk by arrow, date_inserted is one timestamp for the whole run.  Rows with a
+# value that doesn't parse are logged, left out of the batch and added to rejected
+def transform_batch(insights, campaigns, schema, date_inserted, rejected=None):
+    columns = {name: [] for name in list(insight_columns) + list(campaign_columns)}
+    columns["actions"] = []
+    columns["conversions"] = []
+
+    insight_items = list(insight_columns.items())
+    campaign_items = list(campaign_columns.items())
+    for item in insights:
+        for column, field in insight_items:
+            columns[column].append(item.get(field, insight_defaults.get(field)))
+        campaign = campaign_store.lookup_campaign(item.get("campaign_id"), campaigns)
+        for column, field in campaign_items:
+            columns[column].append(campaign.get(field, ""))
+        columns["actions"].append(action_list(item.get("actions")))
+        columns["conversions"].append(action_list(item.get("conversions")))
+
+    count = len(columns["campaign_id"])
+    bad = set()
+    arrays = build_arrays(columns, schema, date_inserted, count, bad)
+    if bad:
+        for index in sorted(bad):
+            row = sources.export_row(insights[index])
+            logger.error("Row rejected by the transform: " + json.dumps(row))
+            if rejected is not None:
+                rejected.append(row)
+        metrics.increment("rows_rejected", len(bad))
+        keep = [index for index in range(count) if index not in bad]
+        columns = {
+            name: [values[index] for index in keep] for name, values in columns.items()
+        }
+        arrays = build_arrays(columns, schema, date_inserted, len(keep), set())
+    return pa.RecordBatch.from_arrays(arrays, schema=schema)
@@ -3,12 +3,11 @@ import gspread
 from google.oauth2 import service_account
 from dotenv import load_dotenv
 import os
-import json
 import pandas as pd
-import time
-from facebook_business.adobjects.adaccount import AdAccount
 from facebook_business.adobjects.adsinsights import AdsInsights
-from facebook_business.adobjects.adset import AdSet
+import graph_batch
+import graph_cache
+import sheet_publisher
 
 load_dotenv()
 account_id = os.getenv("account_id")
@@ -33,67 +32,52 @@ insight_fields = [
     "spend",
 ]
 
-# Initialize Facebook Ads API
-FacebookAdsApi.init(app_id, app_secret, access_token)
+# Initialize Facebook Ads API, responses are cached when GRAPH_CACHE_DIR is set
+graph_cache.install(FacebookAdsApi.init(app_id, app_secret, access_token))
 
 # Fetch campaign data from Facebook Ads API (modify as needed)
 # from facebook_business.adobjects.adaccount import AdAccount
 
 
-def get_campaigns(fb_account_id):
+# Both queries go through the batcher, so their first pages come back in one batch call
+def get_campaigns(batcher, fb_account_id):
     campaign_fields = ["id", "name", "status"]
     campaign_params = {"effective_status": ["ACTIVE"], "limit": "500"}
-    return AdAccount(fb_account_id).get_campaigns(
-        fields=campaign_fields, params=campaign_params
+    return graph_batch.BatchCursor(
+        batcher, (fb_account_id, "campaigns"), campaign_params, campaign_fields
     )
 
 
-def get_adsets(fb_account_id):
-    adset_fields = ["id", "status", "campaign_id"]
-    adset_params = {"effective_status": ["ACTIVE"], "limit": "500"}
-    return AdAccount(fb_account_id).get_ad_sets(
-        fields=adset_fields, params=adset_params
+# ids of the account's active campaigns
+def get_active_campaign_ids(campaigns):
+    return {campaign["id"] for campaign in campaigns}
+
+
+# the insights of every active adset in the account from one account level query at
+# adset level.  The cursor reads the rows 500 at a time as it is iterated
+def get_adset_insights(batcher, fb_account_id):
+    insights_params = {
+        "level": "adset",
+        "limit": "500",
+        "filtering": [
+            {
+                "field": "adset.effective_status",
+                "operator": "IN",
+                "value": ["ACTIVE"],
+            }
+        ],
+    }
+    return graph_batch.BatchCursor(
+        batcher,
+        (fb_account_id, "insights"),
+        insights_params,
+        insight_fields + ["campaign_id"],
     )
 
 
-# helper function to determine if an adset is part of our active campaigns list
-def is_in_campaigns(id, campaigns):
-    for campaign in campaigns:
-        id = campaign["id"]
-        if len(id) > 0:
-            return True
-    return False
-
-
-# get the insights data off an adset
-def get_insights(adset):
-    insights_params = {"level": "ad"}
-    return ad_set.get_insights(fields=insight_fields, params=insights_params)
-
-
-# determine api load for rate limiting
-def get_api_usage_count(response_headers):
-    x_business_use_case_usage = json.loads(
-        response_headers.get("x-business-use-case-usage")
-    )
-
-    # Access the value associated with the key "1180800068778728" - I don't know why this is the key yet
-    response_values = x_business_use_case_usage.get("1180800068778728")
-    response_values = dict(response_values[0])
-    call_count = response_values["call_count"]
-    total_time = response_values["total_time"]
-    total_cputime = response_values["total_cputime"]
-    print(str(call_count) + str(total_time) + str(total_cputime))
-    usage = call_count + total_cputime + total_time
-    return usage
-
-
 # mobile_app_install is part of a list in the 'actions' field.  So this logic exracts that value
-def extract_mobile_installs(ad_insights):
-    # Extract the 'actions' list from the AdInsights object
-    first_ad_insights = ad_insights[0]
-    # ad_insight = ad_insights[0]
-    actions_list = first_ad_insights.get("actions", [])
+def extract_mobile_installs(insights):
+    actions_list = insights.get("actions", [])
 
     # Initialize a variable to store the 'mobile_app_install' value
     mobile_app_install_value = 0
@@ -107,61 +91,42 @@ def extract_mobile_installs(ad_insights):
     return mobile_app_install_value
 
 
-# Convert the AdInsights data to a dictionary row and add mobile installs as a column
-def build_new_row(insights_data):
-    mobile_installs = extract_mobile_installs(insights_data)
-
-    for insights in insights_data:
-        # Extract insight data for the current ad set
-        insights_dict = {}
-        for field in insight_fields:
-            try:
-                insights_dict[field] = insights[field]
-            except KeyError:
-                continue
+# Convert an adset's AdInsights row to a dictionary row and add mobile installs as a column
+def build_new_row(insights):
+    insights_dict = {}
+    for field in insight_fields:
+        try:
+            insights_dict[field] = insights[field]
+        except KeyError:
+            continue
 
-        insights_dict["actions"] = mobile_installs
+    insights_dict["actions"] = extract_mobile_installs(insights)
     return insights_dict
 
 
+# Publish the frame to Google Sheets, updating only the adset rows that changed
 def write_google_sheet(data_frame):
     # Initialize Google Sheets API
     gc = gspread.service_account(filename=google_sheets_credentials)
     sh = gc.open_by_key(google_sheets_spreadsheet_id)
     worksheet = sh.worksheet(google_sheets_worksheet_name)
 
-    # Push data to Google Sheets
-    adsetsData_with_header = [adsetsData.columns.tolist()] + adsetsData.values.tolist()
-    # Update the worksheet with new data
-    worksheet.clear()
-    worksheet.update("A1", adsetsData_with_header)
-
-
-# Get the insights for each Adset and store in a DataFrame
-adsetsData = pd.DataFrame(columns=insight_fields)
-
-campaigns = get_campaigns(account_id)
-adsets = get_adsets(account_id)
-i = 0
-for adset in adsets:
-    adset_id = adset.get_id()
-    if is_in_campaigns(adset_id, campaigns):
-        ad_set = AdSet(fbid=adset_id)
-        insights_data = get_insights(adset)
-
-        response_headers = insights_data.headers()
-        usage = get_api_usage_count(response_headers)
-
-        if usage >= 7:
-            time.sleep(6)
-
-        if len(insights_data) != 0:
-            insights_dict = build_new_row(insights_data)
-            df_row = pd.DataFrame(insights_dict, index=[0])
-            adsetsData = pd.concat([adsetsData, df_row], ignore_index=True)
-    i = i + 1
-    print(str(i))
-    time.sleep(1)
+    calls = sheet_publisher.publish(worksheet, data_frame, "adset_id")
+    print(str(calls) + " sheet updates")
+
+
+# Get the insights of the adsets in our active campaigns and store them in a DataFrame
+batcher = graph_batch.GraphBatcher()
+campaigns = get_campaigns(batcher, account_id)
+adset_insights = get_adset_insights(batcher, account_id)
+campaign_ids = get_active_campaign_ids(campaigns)
+rows = [
+    build_new_row(insights)
+    for insights in adset_insights
+    if insights.get("campaign_id") in campaign_ids
+]
+adsetsData = pd.DataFrame(rows, columns=insight_fields)
+print(str(len(rows)) + " adsets")
 # handle NaN values
 
 adsetsData = adsetsData.fillna(0)
@@ -1,19 +1,37 @@
+import contextvars
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 from google.cloud import bigquery
-from google.cloud.exceptions import NotFound
 from datetime import datetime as dt
 import datetime
 from datetime import timezone
 from facebook_business.api import FacebookAdsApi
 from facebook_business.adobjects.adaccount import AdAccount
-from facebook_business.adobjects.adaccountuser import AdAccountUser
 from facebook_business.adobjects.adsinsights import AdsInsights
 from facebook_business.adobjects.campaign import Campaign
 import settings
-from retry import retry
-import ast
-from rich import print
-
-logger = settings.init_logging()
+import accounts
+import campaign_store
+import clients
+import windows
+import sinks
+import columnar
+import pipeline
+import watermarks
+import async_reports
+import fetch_executor
+import fingerprints
+import graph_batch
+import sources
+import table_layout
+import metrics
+import resilience
+import row_encoder
+
+logger = logging.getLogger()
 attributes = settings.get_secrets()
 
 
@@ -45,9 +63,18 @@ insights_query_fields = [
 ]
 
 
+insights_level = "campaign"
+# days searched for the latest data date when there is no watermark yet
+watermark_fallback_days = 35
+# first day fetched for an account without a watermark, e.g. 2024-01-01.  Without it the
+# account starts from the latest day in the destination table, which other accounts may
+# have loaded
+initial_start_date = os.getenv("ETL_INITIAL_START_DATE", "")
+
+
 def set_insights_query_params(daterange):
     insights_query_params = {
-        "level": "campaign",
+        "level": insights_level,
         "limit": "1000",
         "time_range": daterange,
         "time_increment": 1,
@@ -55,64 +82,123 @@ def set_insights_query_params(daterange):
     return insights_query_params
 
 
-# create a list of days to query based on the last inserted data
-def get_time_ranges(bq_client):
-    date = get_last_insert_date(bq_client)
-    day = date
-    day = day.replace(tzinfo=timezone.utc)
+# create a list of time ranges to query from the last data date loaded, or from the start
+# of the look-back window if that is earlier.  Consecutive days are grouped into multi
+# day windows, the rows still come back one per day
+def get_time_ranges(bq_client, watermark_store, account_id):
+    day = get_start_date(bq_client, watermark_store, account_id)
+    if fingerprints.lookback_days:
+        day = min(day, fingerprints.lookback_start())
 
-    time_ranges = []
-    while day <= datetime.datetime.now(timezone.utc):
-        daystr = day.strftime("%Y-%m-%d")
-        time_ranges.append({
-            "since": daystr,
-            "until": daystr
-        })
-        day = day + datetime.timedelta(days=1)
-        
-
-#    time_ranges = [
-#        {"since": "2025-08-05", "until": "2025-08-06"}
-#    ]
+    days = windows.days_between(day, datetime.datetime.now(timezone.utc).date())
+    time_ranges = windows.plan_windows(days)
+
+    #    time_ranges = [
+    #        {"since": "2025-08-05", "until": "2025-08-06"}
+    #    ]
 
     return time_ranges
 
 
-@retry(backoff=3, tries=6, delay=5)
+@resilience.retrying("graph")
 def get_insights_retry(account, insights_query_fields, qp):
     insights = account.get_insights(insights_query_fields, qp)
     return insights
 
 
-@retry(NotFound, delay=5, tries=6)
-def insert_rows_json_retry(client, data, table):
-    resp = client.insert_rows_json(json_rows=data, table=table)
-    return resp
-
-
-def insert_rows_bigquery(client, table_id, dataset_id, project_id, data):
-    table_ref = "{}.{}.{}".format(project_id, dataset_id, table_id)
-    table = client.get_table(table_ref)
-    resp = None
-    while resp is None:
-        try:
-            resp = insert_rows_json_retry(client, data, table)
-            if len(resp) > 0:
-                logger.info(str(resp))
-            else:
-                logger.info("Success uploaded to table {}".format(table.table_id))
-        except Exception as e:
-            logger.error(e)
-
+# yield (time range, insights) for each time range, either with synchronous requests
+# packed into batch calls, with synchronous get_insights calls run in parallel within our
+# rate limit or through async report runs for large backfills.  Runs sharing an executor
+# share its rate limit
+def fetch_insights(account, time_ranges, executor=None):
+    if not async_reports.use_async_reports and graph_batch.use_batch_requests:
+        yield from fetch_batched_insights(account, time_ranges, executor)
+        return
+
+    if not async_reports.use_async_reports:
+        executor = executor or fetch_executor.FetchExecutor()
+
+        def fetch(timerange):
+            qp = set_insights_query_params(timerange)
+            # get_insights loads the first page, the rest are paged in under the rate
+            # limit as the rows are consumed so a window is never held in memory at once
+            with metrics.timer("insights_request"):
+                insights = get_insights_retry(account, insights_query_fields, qp)
+            executor.record_usage(insights.headers())
+            return timerange, resilience.iter_retrying("graph", insights, executor)
+
+        yield from executor.map(fetch, time_ranges)
+        return
+
+    client = async_reports.GraphReportClient(account, insights_query_fields)
+    params_list = [set_insights_query_params(timerange) for timerange in time_ranges]
+    for qp, insights in async_reports.run_report_jobs(client, params_list):
+        yield qp["time_range"], resilience.iter_retrying("graph", insights)
+
+
+# the first page of up to a batch worth of time ranges is requested in one batch call
+# before the first range is read, later pages as each range is read
+def fetch_batched_insights(account, time_ranges, executor=None):
+    batcher = graph_batch.GraphBatcher(executor=executor)
+    pending = deque()
+    for timerange in time_ranges:
+        cursor = graph_batch.BatchCursor(
+            batcher,
+            (account.get_id(), "insights"),
+            set_insights_query_params(timerange),
+            insights_query_fields,
+        )
+        pending.append((timerange, cursor))
+        if len(pending) >= batcher.size:
+            yield pending.popleft()
+    while pending:
+        yield pending.popleft()
+
+
+# the first day to fetch.  Read from the watermark store.  An account that has never
+# been loaded starts from ETL_INITIAL_START_DATE, or when that isn't set falls back to the
+# newest data date in the recent partitions of the destination table, then to a full
+# scan of the insert dates
+def get_start_date(bq_client, watermark_store, account_id):
+    with metrics.timer("watermark_query"):
+        day = watermark_store.get(account_id, insights_level)
+        if day is not None:
+            return day
+        if initial_start_date:
+            logger.info(
+                account_id + " has no watermark, starting from " + initial_start_date
+            )
+            return datetime.date.fromisoformat(initial_start_date)
+        logger.warning(
+            account_id
+            + " has no watermark, starting from the latest day in the destination "
+            "table.  Set ETL_INITIAL_START_DATE to load its earlier history"
+        )
+        day = get_last_data_date(bq_client)
+        if day is None:
+            day = get_last_insert_date(bq_client).date()
+    return day
+
+
+def get_last_data_date(bq_client):
+    table_name = (
+        attributes["gcp_project_id"]
+        + "."
+        + attributes["dataset_id"]
+        + "."
+        + attributes["table_id"]
+    )
+    sql_query = f"""
+        select max(data_date_start)
+        FROM `{table_name}`
+        where data_date_start >= date_sub(current_date(), interval {watermark_fallback_days} day)
+    """
 
-def lookup_campaign(campaign_id, campaigns):
-    campaign_ret = Campaign()
-    for index in range(len(campaigns)):
-        campaign = campaigns[index]
-        id = campaign.get("id")
-        if id == campaign_id:
-            campaign_ret = campaign
-    return campaign_ret
+    query_job = table_layout.query(bq_client, sql_query)
+    rows = query_job.result()
+    metrics.increment("bq_bytes_scanned", query_job.total_bytes_processed or 0)
+    row = next(rows)
+    return row[0]
 
 
 def get_last_insert_date(bq_client):
@@ -128,86 +214,366 @@ def get_last_insert_date(bq_client):
         FROM `{table_name}`
     """
 
-    query_job = bq_client.query(sql_query)
+    query_job = table_layout.query(bq_client, sql_query)
     rows = query_job.result()
+    metrics.increment("bq_bytes_scanned", query_job.total_bytes_processed or 0)
     row = next(rows)
     return row[0]
 
 
-def get_facebook_data():
-    logger.info("Facebook import function is running. ")
+# flatten insight rows into the destination table layout, joined with campaign fields.
+# A generator so rows can stream from the insights cursor to the sink.  date_inserted is
+# the run timestamp shared by every row
+def transform_insights(insights, campaigns, date_inserted=None):
+    if date_inserted is None:
+        date_inserted = dt.now(timezone.utc)
+    bq_date_time = date_inserted.strftime("%Y-%m-%d %H:%M:%S.%f")
+    for item in insights:
+        actions = []
+        conversions = []
+
+        id = item.get("campaign_id")
+
+        campaign = campaign_store.lookup_campaign(id, campaigns)
+
+        if "actions" in item:
+            for i, value in enumerate(item["actions"]):
+                actions.append(
+                    {"action_type": value["action_type"], "value": value["value"]}
+                )
+
+        if "conversions" in item:
+            for i, value in enumerate(item["conversions"]):
+                conversions.append(
+                    {"action_type": value["action_type"], "value": value["value"]}
+                )
+        yield {
+            "date_inserted": bq_date_time,
+            "data_date_start": item.get("date_start"),
+            "campaign_id": item.get("campaign_id"),
+            "campaign_name": item.get("campaign_name"),
+            "created_time": campaign.get("created_time", ""),
+            "start_time": campaign.get("start_time", ""),
+            "end_time": campaign.get("stop_time", ""),
+            "location": "deprecated",
+            "status": campaign.get("status", ""),
+            "objective": campaign.get("objective", ""),
+            "clicks": item.get("clicks"),
+            "impressions": item.get("impressions"),
+            "reach": item.get("reach"),
+            "cpc": item.get("cpc", "0"),
+            "spend": item.get("spend"),
+            "conversions": conversions,
+            "actions": actions,
+        }
+
+
+# reads campaigns and insights from the Graph API, see sources.py for the interface
+class GraphSource:
+    def __init__(self, account, snapshot_store=None, executor=None):
+        self.account = account
+        self.snapshot_store = snapshot_store
+        self.executor = executor
+
+    def get_campaign_index(self):
+        return campaign_store.get_campaign_index(
+            self.account,
+            campaigns_query_fields,
+            campaigns_query_params,
+            store=self.snapshot_store,
+        )
+
+    def fetch_insights(self, time_ranges):
+        return fetch_insights(self.account, time_ranges, self.executor)
+
+
+# graph or fixture (replays ETL_FIXTURE_PATH)
+etl_source = os.getenv("ETL_SOURCE", "graph")
+fixture_path = os.getenv("ETL_FIXTURE_PATH", "")
+# when set, everything read from the Graph API is also recorded to this fixture file
+record_path = os.getenv("ETL_RECORD_PATH", "")
+# bigquery, ndjson or parquet (written to ETL_SINK_PATH)
+etl_sink = os.getenv("ETL_SINK", "bigquery")
+sink_path = os.getenv("ETL_SINK_PATH", "")
+# the file paths can contain {account_id} to get one file per account, the sink path
+# also {since} to get one file per backfill window
+
+# layout of the destination table
+fb_source_schema = [
+    bigquery.SchemaField("date_inserted", "TIMESTAMP"),
+    bigquery.SchemaField("data_date_start", "DATE"),
+    bigquery.SchemaField("campaign_id", "STRING"),
+    bigquery.SchemaField("campaign_name", "STRING"),
+    bigquery.SchemaField("created_time", "STRING"),
+    bigquery.SchemaField("start_time", "STRING"),
+    bigquery.SchemaField("end_time", "STRING"),
+    bigquery.SchemaField("location", "STRING"),
+    bigquery.SchemaField("status", "STRING"),
+    bigquery.SchemaField("objective", "STRING"),
+    bigquery.SchemaField("clicks", "INTEGER"),
+    bigquery.SchemaField("impressions", "INTEGER"),
+    bigquery.SchemaField("reach", "INTEGER"),
+    bigquery.SchemaField("cpc", "FLOAT"),
+    bigquery.SchemaField("spend", "FLOAT"),
+    bigquery.SchemaField(
+        "conversions",
+        "RECORD",
+        mode="REPEATED",
+        fields=[
+            bigquery.SchemaField("action_type", "STRING"),
+            bigquery.SchemaField("value", "STRING"),
+        ],
+    ),
+    bigquery.SchemaField(
+        "actions",
+        "RECORD",
+        mode="REPEATED",
+        fields=[
+            bigquery.SchemaField("action_type", "STRING"),
+            bigquery.SchemaField("value", "STRING"),
+        ],
+    ),
+]
+
+# checks and converts rows to the destination table's column types before they are sent.
+# Compiled from the table's own schema once ensure_destination_table has fetched it
+fb_row_schema = row_encoder.RowSchema(fb_source_schema)
 
-    bigquery_client = bigquery.Client()
-    FacebookAdsApi.init(
+
+def get_source(account_id, bigquery_client=None, executor=None):
+    if etl_source == "fixture":
+        return sources.FixtureSource(fixture_path.format(account_id=account_id))
+
+    clients.facebook_api(
         attributes["fb_app_id"],
         attributes["fb_app_secret"],
         attributes["fb_access_token"],
     )
-    time_ranges = get_time_ranges(bigquery_client)
-    logger.info(time_ranges)
+    snapshot_store = campaign_store.get_snapshot_store(
+        bigquery_client, attributes["gcp_project_id"], attributes["dataset_id"]
+    )
+    source = GraphSource(AdAccount(account_id), snapshot_store, executor)
+    if record_path:
+        source = sources.RecordingSource(
+            source, record_path.format(account_id=account_id)
+        )
+    return source
 
-    account = AdAccount("act_" + str(attributes["fb_account_id"]))
-    campaigns = account.get_campaigns(campaigns_query_fields, campaigns_query_params)
-    rows = 0
 
-    for timerange in time_ranges:
-        logger.info("Processing timerange: " + str(timerange))
+def destination_table():
+    return "{}.{}.{}".format(
+        attributes["gcp_project_id"], attributes["dataset_id"], attributes["table_id"]
+    )
+
+
+# create the destination table partitioned and clustered, or check its layout, before
+# anything is loaded into it
+def ensure_destination_table(bigquery_client):
+    global fb_row_schema
+    if etl_sink == "bigquery":
+        table = table_layout.ensure_table(
+            bigquery_client, destination_table(), fb_source_schema
+        )
+        fb_row_schema = row_encoder.RowSchema(table.schema)
+
+
+# since names the first day written, for file sink paths with a {since} placeholder
+def get_sink(bigquery_client, account_id, since="", write_mode=None):
+    path = sink_path.format(account_id=account_id, since=since)
+    if etl_sink == "ndjson":
+        return sinks.NdjsonFileSink(path)
+    if etl_sink == "parquet":
+        return sinks.ParquetFileSink(path, fb_source_schema)
+    return sinks.BigQuerySink(
+        bigquery_client,
+        destination_table(),
+        write_mode=write_mode,
+        row_schema=fb_row_schema,
+    )
+
 
-        qp = set_insights_query_params(timerange)
-        insights = get_insights_retry(account, insights_query_fields, qp)
-
-        fb_source = []
-        for index, item in enumerate(insights):
-            actions = []
-            conversions = []
-
-            id = item.get("campaign_id")
-
-            campaign = lookup_campaign(id, campaigns)
-
-            if "actions" in item:
-                for i, value in enumerate(item["actions"]):
-                    actions.append(
-                        {"action_type": value["action_type"], "value": value["value"]}
-                    )
-
-            if "conversions" in item:
-                for i, value in enumerate(item["conversions"]):
-                    conversions.append(
-                        {"action_type": value["action_type"], "value": value["value"]}
-                    )
-            bq_date_time = dt.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")
-            fb_source.append(
-                {
-                    "date_inserted": bq_date_time,
-                    "data_date_start": item.get("date_start"),
-                    "campaign_id": item.get("campaign_id"),
-                    "campaign_name": item.get("campaign_name"),
-                    "created_time": campaign.get("created_time", ""),
-                    "start_time": campaign.get("start_time", ""),
-                    "end_time": campaign.get("stop_time", ""),
-                    "location": "deprecated",
-                    "status": campaign.get("status", ""),
-                    "objective": campaign.get("objective", ""),
-                    "clicks": item.get("clicks"),
-                    "impressions": item.get("impressions"),
-                    "reach": item.get("reach"),
-                    "cpc": item.get("cpc", 0),
-                    "spend": item.get("spend"),
-                    "conversions": conversions,
-                    "actions": actions,
-                }
+# every transformed row of every time range, fetched and transformed as it is consumed.
+# With a change filter only the rows that changed since they were last loaded
+def iter_fb_source(
+    source, time_ranges, campaigns, date_inserted=None, change_filter=None
+):
+    for timerange, insights in source.fetch_insights(time_ranges):
+        logger.info("Processing timerange: " + str(timerange))
+        insights = metrics.timed_iter(insights, "insights_fetch")
+        if change_filter is not None:
+            insights = change_filter.filter(insights, campaigns)
+        yield from transform_insights(insights, campaigns, date_inserted)
+
+
+# the insights of every time range as arrow record batches of up to
+# PIPELINE_BATCH_ROWS rows, see columnar.py.  Rows that don't parse are added to rejected
+def iter_fb_batches(
+    source, time_ranges, campaigns, date_inserted, change_filter=None, rejected=None
+):
+    schema = sinks.arrow_schema(fb_source_schema)
+    for timerange, insights in source.fetch_insights(time_ranges):
+        logger.info("Processing timerange: " + str(timerange))
+        insights = metrics.timed_iter(insights, "insights_fetch")
+        if change_filter is not None:
+            insights = change_filter.filter(insights, campaigns)
+        for items in pipeline.batched(insights):
+            yield columnar.transform_batch(
+                items, campaigns, schema, date_inserted, rejected
             )
 
-       # insert_rows_bigquery(
-       #     bigquery_client,
-       #     attributes["table_id"],
-       #     attributes["dataset_id"],
-       #     attributes["gcp_project_id"],
-       #     fb_source,
-       # )
-        rows = rows + len(fb_source)
+
+# extract, transform and load time_ranges from any source into any sink.  Returns the
+# number of rows written and the latest data date among them.  A change filter (see
+# fingerprints.py) drops unchanged rows and records the rest once the sink is closed.
+# Rows the transform rejects raise RejectedRowsError once everything else is written
+def run_etl(source, sink, time_ranges, change_filter=None):
+    with metrics.timer("campaigns_fetch"):
+        campaigns = source.get_campaign_index()
+    rows = 0
+    last_day = None
+    date_inserted = dt.now(timezone.utc)
+    rejected = []
+
+    start = time.perf_counter()
+    if columnar.use_columnar:
+        batches = iter_fb_batches(
+            source, time_ranges, campaigns, date_inserted, change_filter, rejected
+        )
+    else:
+        fb_source = iter_fb_source(
+            source, time_ranges, campaigns, date_inserted, change_filter
+        )
+        batches = pipeline.batched(fb_source)
+    for batch in batches:
+        with metrics.timer("sink_write"):
+            sink.write(batch)
+        rows = rows + len(batch)
+        last_day = watermarks.latest_day(batch, last_day)
+    # whatever wasn't spent waiting on facebook or the sink went to the transform
+    elapsed = time.perf_counter() - start
+    metrics.add_time(
+        "transform",
+        elapsed - metrics.seconds("insights_fetch") - metrics.seconds("sink_write"),
+    )
+    with metrics.timer("sink_close"):
+        sink.close()
+    if rejected:
+        raise sinks.RejectedRowsError(
+            "{} rows rejected by the transform".format(len(rejected))
+        )
+    if change_filter is not None:
+        change_filter.save()
+    metrics.increment("rows", rows)
+    return rows, last_day
+
+
+# import one account.  Runs with its own run metrics, logged when it finishes
+def import_account(bigquery_client, account_id):
+    metrics.reset()
+    resilience.reset_budget()
+    rows = 0
+    time_ranges = []
+    profile_path = metrics.profile_path and metrics.profile_path + "." + account_id
+    with metrics.profiled(profile_path):
+        watermark_store = watermarks.get_watermark_store(
+            bigquery_client, attributes["gcp_project_id"], attributes["dataset_id"]
+        )
+        time_ranges = get_time_ranges(bigquery_client, watermark_store, account_id)
+        logger.info(account_id + " " + str(time_ranges))
+
+        source = get_source(account_id, bigquery_client)
+        change_filter = fingerprints.get_change_filter(
+            bigquery_client,
+            attributes["gcp_project_id"],
+            attributes["dataset_id"],
+            account_id,
+        )
+        # appended restated rows would sit next to the rows they restate, the look-back
+        # replaces them instead
+        write_mode = None
+        if change_filter is not None and sinks.bigquery_write_mode == "append":
+            write_mode = "replace"
+        sink = get_sink(bigquery_client, account_id, write_mode=write_mode)
+        rows, last_day = run_etl(source, sink, time_ranges, change_filter)
+        # unchanged rows aren't written but were still fetched
+        if change_filter is not None and change_filter.last_day is not None:
+            fetched_day = datetime.date.fromisoformat(change_filter.last_day)
+            last_day = max(last_day or fetched_day, fetched_day)
+
+        # only move the watermark once the rows are in the table, or were there unchanged
+        if etl_sink == "bigquery" and last_day is not None:
+            watermark_store.set(account_id, insights_level, last_day)
+
+    metrics.emit(account_id=account_id, time_ranges=len(time_ranges))
+    return rows
+
+
+# the default api session and the requests it has made so far.  Warm instances keep the
+# session, and its request count, across invocations
+def api_call_mark():
+    api = FacebookAdsApi.get_default_api()
+    if api is None:
+        return None, 0
+    return api, api.get_num_requests_attempted()
+
+
+# requests made since api_call_mark, all of them if the session was replaced since
+def api_calls_since(mark):
+    api = FacebookAdsApi.get_default_api()
+    if api is None:
+        return 0
+    marked_api, marked_calls = mark
+    if api is not marked_api:
+        marked_calls = 0
+    return api.get_num_requests_attempted() - marked_calls
+
+
+# import account_ids (every account in the fb_account_id secret by default) in parallel,
+# up to ETL_ACCOUNT_WORKERS at a time.  Every account is attempted, failures are raised
+# together at the end so the invocation is reported as failed.  The invocation record
+# holds the run metrics current when it is called, each account logs its own
+def get_facebook_data(account_ids=None):
+    settings.init_logging()
+    if account_ids is None:
+        account_ids = accounts.account_ids(attributes["fb_account_id"])
+    logger.info(
+        "Facebook import function is running for {} accounts. ".format(len(account_ids))
+    )
+
+    bigquery_client = clients.bigquery_client()
+    ensure_destination_table(bigquery_client)
+    api_mark = api_call_mark()
+    rows = 0
+    failed = []
+    workers = max(1, min(accounts.account_workers, len(account_ids)))
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = {
+            "act_"
+            + account_id: pool.submit(
+                contextvars.copy_context().run,
+                import_account,
+                bigquery_client,
+                "act_" + account_id,
+            )
+            for account_id in account_ids
+        }
+        for account_id, future in futures.items():
+            try:
+                rows = rows + future.result()
+            except Exception:
+                logger.exception("Import failed for account " + account_id)
+                failed.append(account_id)
+
+    if etl_source == "graph":
+        metrics.gauge("api_calls", api_calls_since(api_mark))
+    metrics.increment("rows", rows)
+    metrics.emit(
+        event="etl_invocation_metrics", accounts=len(account_ids), failed=failed
+    )
     if rows > 0:
         logger.info("Execution complete.  Rows inserted: " + str(rows))
     else:
         logger.warning("Execution complete.  Rows inserted: " + str(rows))
+    if failed:
+        raise RuntimeError("Import failed for accounts " + ", ".join(failed))
+    return rows
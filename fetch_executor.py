@@ -0,0 +1,147 @@
+import contextvars
+import json
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+max_fetch_workers = int(os.getenv("FETCH_WORKERS", "4"))
+# requests per second allowed while the api reports no usage
+max_fetch_rate = float(os.getenv("FETCH_RATE", "4"))
+# usage percentage at which requests stop until facebook says access is regained
+pause_usage_percent = int(os.getenv("FETCH_PAUSE_USAGE", "90"))
+
+
+# read the rate limit usage facebook returns with every response.  Returns the highest
+# call_count / total_time / total_cputime percentage across the business use case and
+# ads insights throttle headers, plus the seconds until access is regained.  Usage is None
+# when the response has no usage headers
+def get_usage(response_headers):
+    usage = None
+    regain_seconds = 0
+    if not response_headers:
+        return usage, regain_seconds
+
+    business_usage = response_headers.get("x-business-use-case-usage")
+    if business_usage:
+        for entries in json.loads(business_usage).values():
+            for entry in entries:
+                entry_usage = max(
+                    entry.get("call_count", 0),
+                    entry.get("total_time", 0),
+                    entry.get("total_cputime", 0),
+                )
+                usage = max(usage or 0, entry_usage)
+                regain_seconds = max(
+                    regain_seconds, entry.get("estimated_time_to_regain_access", 0) * 60
+                )
+
+    insights_throttle = response_headers.get("x-fb-ads-insights-throttle")
+    if insights_throttle:
+        throttle = json.loads(insights_throttle)
+        usage = max(
+            usage or 0,
+            throttle.get("app_id_util_pct", 0),
+            throttle.get("acc_id_util_pct", 0),
+        )
+    return usage, regain_seconds
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity=None):
+        self.rate = rate
+        self.capacity = capacity or max(1.0, rate)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+        self.lock = threading.Lock()
+
+    def set_rate(self, rate):
+        with self.lock:
+            self.refill()
+            self.rate = rate
+
+    def pause(self, seconds):
+        with self.lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    # block until a request may be sent
+    def acquire(self):
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                if now < self.paused_until:
+                    wait = self.paused_until - now
+                else:
+                    self.refill()
+                    if self.tokens >= 1:
+                        self.tokens = self.tokens - 1
+                        return
+                    wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# runs api calls on a thread pool.  Every call waits for a token, and the token rate and
+# number of calls allowed at once shrink as facebook reports more usage of our quota.
+# Tasks report usage by passing response headers to record_usage
+class FetchExecutor:
+    def __init__(self, max_workers=None, rate=None, pause_usage=None):
+        self.max_workers = max_workers or max_fetch_workers
+        self.max_rate = rate or max_fetch_rate
+        self.pause_usage = pause_usage or pause_usage_percent
+        self.bucket = TokenBucket(self.max_rate)
+        self.limit = self.max_workers
+        self.active = 0
+        self.usage = 0
+        self.condition = threading.Condition()
+
+    def record_usage(self, response_headers):
+        usage, regain_seconds = get_usage(response_headers)
+        if usage is None:
+            return
+        headroom = max(0.05, (100 - min(usage, 100)) / 100)
+        with self.condition:
+            self.usage = usage
+            self.limit = max(1, int(round(self.max_workers * headroom)))
+            self.condition.notify_all()
+        self.bucket.set_rate(self.max_rate * headroom)
+        metrics.gauge_min("rate_limit_headroom_percent", 100 - min(usage, 100))
+        if usage >= self.pause_usage:
+            metrics.increment("rate_limit_pauses")
+            self.bucket.pause(max(regain_seconds, 60))
+
+    def run(self, fn, item):
+        with self.condition:
+            while self.active >= self.limit:
+                self.condition.wait()
+            self.active = self.active + 1
+        try:
+            self.bucket.acquire()
+            return fn(item)
+        finally:
+            with self.condition:
+                self.active = self.active - 1
+                self.condition.notify_all()
+
+    # call fn for every item concurrently, yielding the results in the order of items.
+    # Only max_workers results are waiting to be consumed at any time so memory stays
+    # bounded however many items there are.  Calls run in a copy of the caller's context
+    # so they record to the caller's run metrics
+    def map(self, fn, items):
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            futures = deque()
+            for item in items:
+                context = contextvars.copy_context()
+                futures.append(pool.submit(context.run, self.run, fn, item))
+                if len(futures) >= self.max_workers:
+                    yield futures.popleft().result()
+            while futures:
+                yield futures.popleft().result()
@@ -0,0 +1,134 @@
+import datetime
+import hashlib
+import json
+import os
+
+from google.cloud import bigquery
+
+import campaign_store
+import metrics
+import sources
+import state_store
+
+# facebook keeps restating spend, actions and conversions for days afterwards.  Every run
+# fetches the lookback_days days before today again, whatever the watermark says, and only
+# rows that differ from what was loaded last time are written.  0 turns it off
+lookback_days = int(os.getenv("LOOKBACK_DAYS", "3"))
+# bigquery keeps fingerprints in a table next to the destination table, file in a local
+# json file
+fingerprint_store_type = os.getenv("FINGERPRINT_STORE", "bigquery")
+fingerprint_table_id = os.getenv("FINGERPRINT_TABLE", "etl_fingerprints")
+fingerprint_path = os.getenv("FINGERPRINT_PATH", "/tmp/fingerprints.json")
+
+# the campaign fields that end up in a row next to its insights
+campaign_fields = ["created_time", "start_time", "stop_time", "status", "objective"]
+
+fingerprint_schema = [
+    bigquery.SchemaField("account_id", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("fingerprints", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("updated_at", "TIMESTAMP"),
+]
+
+
+# a hash of everything a row is made of: the insight as facebook returned it and the
+# fields of its campaign
+def fingerprint(insight, campaign):
+    values = [insight, [campaign.get(field) for field in campaign_fields]]
+    data = json.dumps(values, sort_keys=True, default=str)
+    return hashlib.sha1(data.encode("utf-8")).hexdigest()
+
+
+# fingerprints of the rows last loaded for each account, {day: {campaign_id: hash}},
+# kept in a json file
+class FileFingerprintStore:
+    def __init__(self, path):
+        self.file = state_store.JsonFile(path)
+
+    def read(self, account_id):
+        return self.file.read().get(account_id, {})
+
+    def write(self, account_id, fingerprints):
+        with self.file.updating() as stored:
+            stored[account_id] = fingerprints
+
+
+# fingerprints of the rows last loaded for each account, one row per account with the
+# fingerprints as json.  Only the look-back days are kept so the row stays small
+class BigQueryFingerprintStore:
+    def __init__(self, client, table_ref):
+        self.rows = state_store.BigQueryRowStore(
+            client, table_ref, fingerprint_schema, ["account_id"]
+        )
+
+    def read(self, account_id):
+        row = self.rows.get(account_id=account_id)
+        if row is None:
+            return {}
+        return json.loads(row["fingerprints"])
+
+    def write(self, account_id, fingerprints):
+        self.rows.put(account_id=account_id, fingerprints=json.dumps(fingerprints))
+
+
+def get_fingerprint_store(client, project_id, dataset_id):
+    if fingerprint_store_type == "file":
+        return FileFingerprintStore(fingerprint_path)
+    table_ref = "{}.{}.{}".format(project_id, dataset_id, fingerprint_table_id)
+    return BigQueryFingerprintStore(client, table_ref)
+
+
+# the first day of the look-back window
+def lookback_start(today=None):
+    today = today or datetime.datetime.now(datetime.timezone.utc).date()
+    return today - datetime.timedelta(days=lookback_days)
+
+
+# drops insight rows that are the same as when they were last loaded.  save() stores the
+# fingerprints of the rows seen, call it once they are in the destination table
+class ChangeFilter:
+    def __init__(self, store, account_id):
+        self.store = store
+        self.account_id = account_id
+        self.stored = store.read(account_id)
+        self.seen = {}
+        # the latest day fetched, written or not
+        self.last_day = None
+
+    def filter(self, insights, campaigns):
+        for insight in insights:
+            row = sources.export_row(insight)
+            day = row.get("date_start")
+            campaign_id = row.get("campaign_id")
+            campaign = campaign_store.lookup_campaign(campaign_id, campaigns)
+            row_hash = fingerprint(row, campaign)
+            self.seen.setdefault(day, {})[campaign_id] = row_hash
+            if day and (self.last_day is None or day > self.last_day):
+                self.last_day = day
+
+            stored_hash = self.stored.get(day, {}).get(campaign_id)
+            if stored_hash == row_hash:
+                metrics.increment("rows_unchanged")
+                continue
+            if stored_hash is not None:
+                metrics.increment("rows_restated")
+            yield insight
+
+    def save(self):
+        oldest = lookback_start().isoformat()
+        fingerprints = {
+            day: campaigns
+            for day, campaigns in self.stored.items()
+            if day >= oldest and day not in self.seen
+        }
+        fingerprints.update(
+            {day: campaigns for day, campaigns in self.seen.items() if day >= oldest}
+        )
+        self.store.write(self.account_id, fingerprints)
+
+
+# a change filter for an account's run, None when the look-back is turned off
+def get_change_filter(client, project_id, dataset_id, account_id):
+    if not lookback_days:
+        return None
+    store = get_fingerprint_store(client, project_id, dataset_id)
+    return ChangeFilter(store, account_id)
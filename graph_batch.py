@@ -0,0 +1,226 @@
+import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+from concurrent.futures import Future
+
+from facebook_business.api import FacebookAdsApi, FacebookResponse
+from requests.structures import CaseInsensitiveDict
+
+import fetch_executor
+import graph_cache
+import metrics
+import resilience
+
+logger = logging.getLogger()
+
+# send fan-out requests (one per time range, campaign or adset) as Graph API batch calls
+use_batch_requests = os.getenv("GRAPH_BATCH", "True") == "True"
+# sub-requests per batch call, the Graph API takes at most 50
+batch_size = int(os.getenv("GRAPH_BATCH_SIZE", "50"))
+
+
+# a sub-request the api returned no response for, it timed out inside the batch
+class BatchTimeoutError(Exception):
+    pass
+
+
+# the response body of a submitted request.  Asking for the result sends the batcher's
+# queue until this request has been answered
+class BatchFuture(Future):
+    def __init__(self, batcher):
+        super().__init__()
+        self.batcher = batcher
+
+    def result(self, timeout=None):
+        if not self.done():
+            self.batcher.flush(until=self)
+        return super().result(timeout)
+
+    def exception(self, timeout=None):
+        if not self.done():
+            self.batcher.flush(until=self)
+        return super().exception(timeout)
+
+
+# a queued request, in the form of one entry of a batch call
+class BatchCall:
+    def __init__(self, batcher, method, path, params):
+        if not isinstance(path, str):
+            path = "/".join(str(part) for part in path)
+        self.method = method
+        self.path = path
+        self.params = params
+        self.future = BatchFuture(batcher)
+        self.attempts = 0
+
+    def entry(self):
+        encoded = urllib.parse.urlencode(
+            {
+                key: value if isinstance(value, str) else json.dumps(value)
+                for key, value in self.params.items()
+            }
+        )
+        entry = {"method": self.method, "relative_url": self.path}
+        if encoded and self.method == "GET":
+            entry["relative_url"] = self.path + "?" + encoded
+        elif encoded:
+            entry["body"] = encoded
+        return entry
+
+
+# packs the requests submitted to it into batch calls of up to size requests, and hands
+# each response to the future of the request it answers.  Sub-requests that fail with a
+# transient error or time out are queued again after a backoff, within the run's retry
+# budget.  Every batch call waits for the executor's rate limit and reports its usage
+# headers back to it, a batcher made without one gets its own.  With the response cache
+# installed requests are sent one by one instead, batch calls are POSTs the cache can't
+# answer
+class GraphBatcher:
+    def __init__(self, api=None, size=None, executor=None):
+        self.api = api or FacebookAdsApi.get_default_api()
+        self.size = size or batch_size
+        self.executor = executor or fetch_executor.FetchExecutor()
+        self.queue = []
+        self.lock = threading.Lock()
+
+    # queue a request, returns a future for its parsed response body
+    def submit(self, method, path, params=None, fields=None):
+        params = dict(params or {})
+        if fields:
+            params["fields"] = ",".join(fields)
+        call = BatchCall(self, method, path, params)
+        with self.lock:
+            self.queue.append(call)
+        return call.future
+
+    # send queued requests until the queue is empty, or until a future is answered
+    def flush(self, until=None):
+        while until is None or not until.done():
+            with self.lock:
+                calls = self.queue[: self.size]
+                del self.queue[: self.size]
+            if not calls:
+                return
+            try:
+                self.executor.run(self.send, calls)
+            except Exception as e:
+                # the batch call itself failed, after its own retries
+                for call in calls:
+                    if not call.future.done():
+                        call.future.set_exception(e)
+
+    def send(self, calls):
+        if graph_cache.installed(self.api):
+            for call in calls:
+                self.send_one(call)
+            return
+
+        response = resilience.call(
+            "graph",
+            self.api.call,
+            "POST",
+            (),
+            params={"batch": [call.entry() for call in calls]},
+        )
+        self.executor.record_usage(response.headers())
+        metrics.increment("graph_batch_calls")
+        metrics.increment("graph_batch_requests", len(calls))
+
+        retries = []
+        for call, item in zip(calls, response.json()):
+            if not item:
+                error = BatchTimeoutError(
+                    "No response for {} {}".format(call.method, call.path)
+                )
+                self.retry_or_fail(call, error, retries)
+                continue
+            headers = CaseInsensitiveDict(
+                {
+                    header["name"]: header["value"]
+                    for header in item.get("headers") or []
+                }
+            )
+            sub_response = FacebookResponse(
+                body=item.get("body"),
+                headers=headers,
+                http_status=item.get("code"),
+                call=call.entry(),
+            )
+            # sub-responses can carry their own usage headers
+            self.executor.record_usage(headers)
+            if sub_response.is_success():
+                call.future.set_result(sub_response.json())
+                continue
+            error = sub_response.error()
+            if resilience.is_transient(error):
+                self.retry_or_fail(call, error, retries)
+            else:
+                call.future.set_exception(error)
+
+        if retries:
+            delay = max(
+                resilience.backoff_seconds(call.attempts, error)
+                for call, error in retries
+            )
+            logger.warning(
+                "{} batched requests failed, retry in {:.1f}s".format(
+                    len(retries), delay
+                )
+            )
+            metrics.increment("retries", len(retries))
+            with metrics.timer("retry_wait"):
+                time.sleep(delay)
+            with self.lock:
+                self.queue[:0] = [call for call, error in retries]
+
+    def retry_or_fail(self, call, error, retries):
+        call.attempts = call.attempts + 1
+        if call.attempts >= resilience.max_attempts or not resilience.take_retry(
+            "graph"
+        ):
+            call.future.set_exception(error)
+            return
+        retries.append((call, error))
+
+    def send_one(self, call):
+        try:
+            response = resilience.call(
+                "graph",
+                self.api.call,
+                call.method,
+                call.path.split("/"),
+                params=call.params,
+            )
+        except Exception as e:
+            call.future.set_exception(e)
+            return
+        self.executor.record_usage(response.headers())
+        call.future.set_result(response.json())
+
+
+# the rows of an edge such as account insights, read a page at a time through a batcher.
+# The first page is submitted straight away so the first pages of many edges share batch
+# calls, each further page is submitted when the one before it has been read
+class BatchCursor:
+    def __init__(self, batcher, path, params=None, fields=None):
+        self.batcher = batcher
+        self.path = path
+        self.params = dict(params or {})
+        self.fields = fields
+        self.page = batcher.submit("GET", path, self.params, fields)
+
+    def __iter__(self):
+        while self.page is not None:
+            response = self.page.result()
+            self.page = None
+            paging = response.get("paging", {})
+            after = paging.get("cursors", {}).get("after")
+            if "next" in paging and after:
+                self.params["after"] = after
+                self.page = self.batcher.submit(
+                    "GET", self.path, self.params, self.fields
+                )
+            yield from response.get("data", [])
@@ -0,0 +1,205 @@
+import datetime
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+import urllib.parse
+
+from requests.structures import CaseInsensitiveDict
+
+import metrics
+
+logger = logging.getLogger()
+
+# directory to cache Graph API GET responses in, caching is off when empty
+cache_dir = os.getenv("GRAPH_CACHE_DIR", "")
+# readwrite serves fresh cached responses and stores new ones, replay only serves cached
+# responses, however old, and fails on anything else
+cache_mode = os.getenv("GRAPH_CACHE_MODE", "readwrite")
+# total size of the cached responses, least recently used ones are dropped past it
+cache_max_bytes = int(os.getenv("GRAPH_CACHE_MAX_BYTES", str(512 * 1024 * 1024)))
+# seconds a response stays fresh: insights for days that can't change any more, insights
+# that include the last couple of days, and everything else (campaigns, adsets, pages)
+closed_days_ttl = int(os.getenv("GRAPH_CACHE_CLOSED_TTL", str(7 * 24 * 3600)))
+open_days_ttl = int(os.getenv("GRAPH_CACHE_OPEN_TTL", "600"))
+default_ttl = int(os.getenv("GRAPH_CACHE_TTL", "3600"))
+# insights for days this far back are treated as closed
+closed_after_days = 2
+
+# rate limit headers describe the quota at the time, replaying them would throttle us
+# for nothing
+usage_headers = {
+    "x-app-usage",
+    "x-ad-account-usage",
+    "x-business-use-case-usage",
+    "x-fb-ads-insights-throttle",
+}
+
+
+class CacheMissError(Exception):
+    pass
+
+
+# a stored response with what facebook_business reads off a requests response
+class CachedResponse:
+    def __init__(self, entry):
+        self.text = entry["body"]
+        self.status_code = entry["status"]
+        self.headers = CaseInsensitiveDict(entry["headers"])
+        self.request = None
+
+
+# the cache key of a request, the same for the same endpoint and params in any order
+def request_key(method, url, params):
+    url = urllib.parse.urlsplit(url)
+    normalized = {}
+    for key, value in (params or {}).items():
+        if key == "fields":
+            value = ",".join(sorted(str(value).split(",")))
+        normalized[key] = str(value)
+    key = json.dumps([method, url.path, normalized], sort_keys=True)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+# seconds a response to the request stays fresh, 0 for requests never cached such as
+# async report status polls
+def request_ttl(url, params):
+    parts = [part for part in urllib.parse.urlsplit(url).path.split("/") if part]
+    # /vXX.X/node is a single object, e.g. a report run whose status keeps changing
+    if len(parts) < 3:
+        return 0
+    time_range = (params or {}).get("time_range")
+    if parts[-1] != "insights" or not time_range:
+        return default_ttl
+    if isinstance(time_range, str):
+        time_range = json.loads(time_range)
+    until = datetime.date.fromisoformat(time_range["until"])
+    closed = datetime.datetime.now(datetime.timezone.utc).date() - datetime.timedelta(
+        days=closed_after_days
+    )
+    if until <= closed:
+        return closed_days_ttl
+    return open_days_ttl
+
+
+# response files in a directory, one per request key.  A file's modification time is its
+# last use, the least recently used files are removed once the directory is over max_bytes
+class ResponseCache:
+    def __init__(self, path, max_bytes=None):
+        self.path = path
+        self.max_bytes = cache_max_bytes if max_bytes is None else max_bytes
+        os.makedirs(path, exist_ok=True)
+        self.lock = threading.Lock()
+        self.size = sum(entry.stat().st_size for entry in self.entries())
+
+    def entries(self):
+        return [
+            entry for entry in os.scandir(self.path) if entry.name.endswith(".json")
+        ]
+
+    def file(self, key):
+        return os.path.join(self.path, key + ".json")
+
+    # the entry for key, None when there is none or, unless stale is ok, it has expired
+    def get(self, key, stale_ok=False):
+        path = self.file(key)
+        try:
+            with open(path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if not stale_ok and time.time() - entry["stored_at"] >= entry["ttl"]:
+            return None
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        return entry
+
+    def put(self, key, entry):
+        data = json.dumps(entry)
+        path = self.file(key)
+        tmp_path = path + "." + str(threading.get_ident()) + ".tmp"
+        with open(tmp_path, "w") as f:
+            f.write(data)
+        with self.lock:
+            old_size = os.path.getsize(path) if os.path.exists(path) else 0
+            os.replace(tmp_path, path)
+            self.size = self.size + len(data) - old_size
+            if self.size > self.max_bytes:
+                self.evict()
+
+    def evict(self):
+        for entry in sorted(self.entries(), key=lambda entry: entry.stat().st_mtime):
+            if self.size <= self.max_bytes * 0.9:
+                return
+            size = entry.stat().st_size
+            try:
+                os.remove(entry.path)
+            except OSError:
+                continue
+            self.size = self.size - size
+            metrics.increment("graph_cache_evictions")
+
+
+# stands in for the requests session of a FacebookSession, answering GET requests from
+# the cache and passing everything else to the real session
+class CachingSession:
+    def __init__(self, session, cache, mode=None):
+        self.session = session
+        self.cache = cache
+        self.mode = mode or cache_mode
+
+    def __getattr__(self, name):
+        return getattr(self.session, name)
+
+    def request(self, method, url, params=None, **kwargs):
+        ttl = request_ttl(url, params) if method == "GET" else 0
+        if not ttl and self.mode != "replay":
+            return self.session.request(method, url, params=params, **kwargs)
+
+        key = request_key(method, url, params)
+        entry = self.cache.get(key, stale_ok=self.mode == "replay")
+        if entry is not None:
+            metrics.increment("graph_cache_hits")
+            return CachedResponse(entry)
+        if self.mode == "replay":
+            raise CacheMissError("No cached response for {} {}".format(method, url))
+
+        metrics.increment("graph_cache_misses")
+        response = self.session.request(method, url, params=params, **kwargs)
+        if response.status_code == 200:
+            headers = {
+                name: value
+                for name, value in response.headers.items()
+                if name.lower() not in usage_headers
+            }
+            entry = {
+                "url": url,
+                "status": response.status_code,
+                "headers": headers,
+                "body": response.text,
+                "stored_at": time.time(),
+                "ttl": ttl,
+            }
+            self.cache.put(key, entry)
+        return response
+
+
+# whether an api's requests go through the response cache
+def installed(api):
+    return isinstance(api._session.requests, CachingSession)
+
+
+# route an api's requests through the response cache in GRAPH_CACHE_DIR, if one is set
+def install(api, path=None, mode=None):
+    path = path or cache_dir
+    if not path or api is None:
+        return api
+    session = api._session
+    if not installed(api):
+        session.requests = CachingSession(session.requests, ResponseCache(path), mode)
+        logger.info("Graph API responses cached in " + path)
+    return api
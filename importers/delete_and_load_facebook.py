@@ -1,19 +1,22 @@
-from google.cloud import bigquery
-from google.cloud.exceptions import NotFound
+import logging
 from datetime import datetime as dt
 import datetime
-from facebook_business.api import FacebookAdsApi
 from facebook_business.adobjects.adaccount import AdAccount
-from facebook_business.adobjects.adaccountuser import AdAccountUser
 from facebook_business.adobjects.adsinsights import AdsInsights
 from facebook_business.adobjects.campaign import Campaign
 import settings
-from retry import retry
-import ast
+import clients
+import campaign_store
+import windows
+import sinks
+import table_layout
+import pipeline
+import watermarks
+import resilience
 from rich import print
 from datetime import timezone
 
-logger = settings.init_logging()
+logger = logging.getLogger()
 attributes = settings.get_secrets()
 
 
@@ -45,9 +48,14 @@ insights_query_fields = [
 ]
 
 
+insights_level = "campaign"
+# days searched for the latest data date when there is no watermark yet
+watermark_fallback_days = 35
+
+
 def set_insights_query_params(daterange):
     insights_query_params = {
-        "level": "campaign",
+        "level": insights_level,
         "limit": "1000",
         "time_range": daterange,
         "time_increment": 1,
@@ -55,63 +63,55 @@ def set_insights_query_params(daterange):
     return insights_query_params
 
 
-# create a list of days to query based on the last inserted data
-def get_time_ranges(bq_client):
-    date = get_last_insert_date(bq_client)
+# create a list of time ranges to query from the last data date loaded.  Consecutive
+# days are grouped into multi day windows, the rows still come back one per day
+def get_time_ranges(bq_client, watermark_store, account_id):
+    date = get_start_date(bq_client, watermark_store, account_id)
     print(str(date))
 
-    time_ranges = "["
-    day = date
-
-    while day <= datetime.datetime.now(timezone.utc):  # go until today
-        daystr = day.strftime("%Y-%m-%d")
-        nextday = day + datetime.timedelta(days=1)
-        time_ranges += (
-            '\'{"since": "' + daystr + '", "until": "' + daystr + "\"}',"
-        )  # this makes it go midnight to midnight on the same day
-        day = nextday
+    # go until today
+    days = windows.days_between(date, datetime.datetime.now(timezone.utc).date())
 
-    time_ranges += "]"
+    # time_ranges = [{"since": "2023-09-05", "until": "2023-12-05"}]
+    return windows.plan_windows(days)
 
-    # time_ranges = '[ \'{"since": "2023-09-05", "until": "2023-12-05"}\']'
-    return ast.literal_eval(time_ranges)
 
-
-@retry(backoff=3, tries=6, delay=5)
+@resilience.retrying("graph")
 def get_insights_retry(account, insights_query_fields, qp):
     insights = account.get_insights(insights_query_fields, qp)
     return insights
 
 
-@retry(NotFound, delay=5, tries=6)
-def insert_rows_json_retry(client, data, table):
-    resp = client.insert_rows_json(json_rows=data, table=table)
-    return resp
-
+# the first day to fetch.  Read from the watermark store, falling back to the newest
+# data date in the recent partitions of the destination table, then to a full scan of
+# the insert dates for an account that has never been loaded
+def get_start_date(bq_client, watermark_store, account_id):
+    day = watermark_store.get(account_id, insights_level)
+    if day is None:
+        day = get_last_data_date(bq_client)
+    if day is None:
+        day = get_last_insert_date(bq_client).date()
+    return day
 
-def insert_rows_bigquery(client, table_id, dataset_id, project_id, data):
-    table_ref = "{}.{}.{}".format(project_id, dataset_id, table_id)
-    table = client.get_table(table_ref)
-    resp = None
-    while resp is None:
-        try:
-            resp = insert_rows_json_retry(client, data, table)
-            if len(resp) > 0:
-                logger.info(str(resp))
-            else:
-                logger.info("Success uploaded to table {}".format(table.table_id))
-        except Exception as e:
-            logger.error(e)
 
+def get_last_data_date(bq_client):
+    table_name = (
+        attributes["gcp_project_id"]
+        + "."
+        + attributes["dataset_id"]
+        + "."
+        + attributes["table_id"]
+    )
+    sql_query = f"""
+        select max(data_date_start)
+        FROM `{table_name}`
+        where data_date_start >= date_sub(current_date(), interval {watermark_fallback_days} day)
+    """
 
-def lookup_campaign(campaign_id, campaigns):
-    campaign_ret = Campaign()
-    for index in range(len(campaigns)):
-        campaign = campaigns[index]
-        id = campaign.get("id")
-        if id == campaign_id:
-            campaign_ret = campaign
-    return campaign_ret
+    query_job = table_layout.query(bq_client, sql_query)
+    rows = query_job.result()
+    row = next(rows)
+    return row[0]
 
 
 def get_last_insert_date(bq_client):
@@ -127,84 +127,103 @@ def get_last_insert_date(bq_client):
         FROM `{table_name}`
     """
 
-    query_job = bq_client.query(sql_query)
+    query_job = table_layout.query(bq_client, sql_query)
     rows = query_job.result()
     row = next(rows)
     return row[0]
 
 
+# flatten insight rows into the destination table layout, joined with campaign fields.
+# A generator so rows can stream from the insights cursor to the sink
+def transform_insights(insights, campaigns):
+    for item in insights:
+        actions = []
+        conversions = []
+
+        id = item.get("campaign_id")
+
+        campaign = campaign_store.lookup_campaign(id, campaigns)
+
+        if "actions" in item:
+            for i, value in enumerate(item["actions"]):
+                actions.append(
+                    {"action_type": value["action_type"], "value": value["value"]}
+                )
+
+        if "conversions" in item:
+            for i, value in enumerate(item["conversions"]):
+                conversions.append(
+                    {"action_type": value["action_type"], "value": value["value"]}
+                )
+        bq_date_time = dt.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")
+        yield {
+            "date_inserted": bq_date_time,
+            "data_date_start": item.get("date_start"),
+            "campaign_id": item.get("campaign_id"),
+            "campaign_name": item.get("campaign_name"),
+            "created_time": campaign.get("created_time", ""),
+            "start_time": campaign.get("start_time", ""),
+            "end_time": campaign.get("stop_time", ""),
+            "location": "deprecated",
+            "status": campaign.get("status", ""),
+            "objective": campaign.get("objective", ""),
+            "clicks": item.get("clicks"),
+            "impressions": item.get("impressions"),
+            "reach": item.get("reach"),
+            "cpc": item.get("cpc", 0),
+            "spend": item.get("spend"),
+            "conversions": conversions,
+            "actions": actions,
+        }
+
+
+# every transformed row of every time range, fetched and transformed as it is consumed
+def iter_fb_source(account, time_ranges, campaigns):
+    for timerange in time_ranges:
+        logger.info("Processing timerange: " + str(timerange))
+        print("Processing timerange: " + str(timerange))
+        qp = set_insights_query_params(timerange)
+        insights = get_insights_retry(account, insights_query_fields, qp)
+        yield from transform_insights(
+            resilience.iter_retrying("graph", insights), campaigns
+        )
+
+
 def get_facebook_data():
+    settings.init_logging()
+    resilience.reset_budget()
     logger.info("Facebook import function is running. ")
 
-    bigquery_client = bigquery.Client()
-    FacebookAdsApi.init(
+    bigquery_client = clients.bigquery_client()
+    clients.facebook_api(
         attributes["fb_app_id"],
         attributes["fb_app_secret"],
         attributes["fb_access_token"],
     )
-    time_ranges = get_time_ranges(bigquery_client)
+    account_id = "act_" + str(attributes["fb_account_id"])
+    watermark_store = watermarks.get_watermark_store(
+        bigquery_client, attributes["gcp_project_id"], attributes["dataset_id"]
+    )
+    time_ranges = get_time_ranges(bigquery_client, watermark_store, account_id)
     logger.info(time_ranges)
 
-    account = AdAccount("act_" + str(attributes["fb_account_id"]))
-    campaigns = account.get_campaigns(campaigns_query_fields, campaigns_query_params)
-    rows = 0
-
-    for timerange in time_ranges:
-        logger.info("Processing timerange: " + str(timerange))
-        print("Processing timerange: " + str(timerange))
-        qp = set_insights_query_params(timerange)
-        insights = get_insights_retry(account, insights_query_fields, qp)
-
-        fb_source = []
-        for index, item in enumerate(insights):
-            actions = []
-            conversions = []
-
-            id = item.get("campaign_id")
-
-            campaign = lookup_campaign(id, campaigns)
-
-            if "actions" in item:
-                for i, value in enumerate(item["actions"]):
-                    actions.append(
-                        {"action_type": value["action_type"], "value": value["value"]}
-                    )
-
-            if "conversions" in item:
-                for i, value in enumerate(item["conversions"]):
-                    conversions.append(
-                        {"action_type": value["action_type"], "value": value["value"]}
-                    )
-            bq_date_time = dt.now(timezone.utc).strftime("%Y-%m-%d %H:%M:%S.%f")
-            fb_source.append(
-                {
-                    "date_inserted": bq_date_time,
-                    "data_date_start": item.get("date_start"),
-                    "campaign_id": item.get("campaign_id"),
-                    "campaign_name": item.get("campaign_name"),
-                    "created_time": campaign.get("created_time", ""),
-                    "start_time": campaign.get("start_time", ""),
-                    "end_time": campaign.get("stop_time", ""),
-                    "location": "deprecated",
-                    "status": campaign.get("status", ""),
-                    "objective": campaign.get("objective", ""),
-                    "clicks": item.get("clicks"),
-                    "impressions": item.get("impressions"),
-                    "reach": item.get("reach"),
-                    "cpc": item.get("cpc", 0),
-                    "spend": item.get("spend"),
-                    "conversions": conversions,
-                    "actions": actions,
-                }
-            )
-
-        insert_rows_bigquery(
-            bigquery_client,
-            attributes["table_id"],
-            attributes["dataset_id"],
-            attributes["gcp_project_id"],
-            fb_source,
-        )
-        rows = rows + len(fb_source)
+    account = AdAccount(account_id)
+    campaigns = campaign_store.get_campaign_index(
+        account, campaigns_query_fields, campaigns_query_params
+    )
+    table_ref = "{}.{}.{}".format(
+        attributes["gcp_project_id"], attributes["dataset_id"], attributes["table_id"]
+    )
+    sink = sinks.BigQuerySink(bigquery_client, table_ref)
 
+    rows = 0
+    last_day = None
+    for batch in pipeline.batched(iter_fb_source(account, time_ranges, campaigns)):
+        sink.write(batch)
+        rows = rows + len(batch)
+        last_day = watermarks.latest_day(batch, last_day)
+    sink.close()
+    # only move the watermark once the rows are in the table
+    if rows > 0:
+        watermark_store.set(account_id, insights_level, last_day)
     logger.info("Execution complete.  Rows inserted: " + str(rows))
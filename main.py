@@ -1,7 +1,32 @@
+import datetime
+
+import accounts
+import backfill
 import facebook as fb
-import importers.delete_and_load_facebook as dlfb
+import metrics
 
 
+# the event picks the accounts to import, see accounts.py.  A coordinator event splits
+# every account into shard events and hands them to the dispatcher instead.  The run
+# metrics start here so the invocation record includes reading the secrets
 def import_data(event, context="local"):
-    fb.get_facebook_data()
+    metrics.reset()
+    payload = accounts.parse_event(event)
+    all_accounts = fb.attributes["fb_account_id"]
+    if payload.get("coordinate"):
+        shards = accounts.make_shards(all_accounts, payload.get("shard_size"))
+        accounts.get_dispatcher(import_data).dispatch(shards)
+        return "ok"
+    if "backfill" in payload:
+        # {"backfill": {"since": ..., "until": ..., "id": ..., "restart": ...}}
+        options = payload["backfill"]
+        backfill.run_backfill(
+            accounts.select_accounts(payload, all_accounts),
+            datetime.date.fromisoformat(options["since"]),
+            datetime.date.fromisoformat(options["until"]),
+            backfill_id=options.get("id"),
+            restart=options.get("restart", False),
+        )
+        return "ok"
+    fb.get_facebook_data(accounts.select_accounts(payload, all_accounts))
     return "ok"
@@ -0,0 +1,158 @@
+import contextvars
+import cProfile
+import io
+import logging
+import os
+import pstats
+import threading
+import time
+from collections import Counter
+from contextlib import contextmanager
+
+logger = logging.getLogger()
+
+# set to a file path to profile each run with cProfile and dump the stats there
+profile_path = os.getenv("ETL_PROFILE", "")
+
+
+# timers, counters and gauges for one run, logged as a single structured record at the end
+class RunMetrics:
+    def __init__(self):
+        self.started = time.time()
+        self.counters = Counter()
+        self.timers = {}
+        self.gauges = {}
+        self.lock = threading.Lock()
+
+    def increment(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters[name] + value
+
+    def add_time(self, name, seconds):
+        with self.lock:
+            timer = self.timers.setdefault(
+                name, {"count": 0, "seconds": 0.0, "max_seconds": 0.0}
+            )
+            timer["count"] = timer["count"] + 1
+            timer["seconds"] = timer["seconds"] + seconds
+            timer["max_seconds"] = max(timer["max_seconds"], seconds)
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def seconds(self, name):
+        with self.lock:
+            return self.timers.get(name, {}).get("seconds", 0.0)
+
+    def gauge(self, name, value):
+        with self.lock:
+            self.gauges[name] = value
+
+    # keep the lowest value seen, e.g. the least rate limit headroom during the run
+    def gauge_min(self, name, value):
+        with self.lock:
+            if name not in self.gauges or value < self.gauges[name]:
+                self.gauges[name] = value
+
+    def record(self, **fields):
+        with self.lock:
+            record = {
+                "event": "etl_run_metrics",
+                "duration_seconds": round(time.time() - self.started, 3),
+                "counters": dict(self.counters),
+                "timers": {
+                    name: {key: round(value, 4) for key, value in timer.items()}
+                    for name, timer in self.timers.items()
+                },
+                "gauges": dict(self.gauges),
+            }
+        record.update(fields)
+        return record
+
+
+# the metrics of the run in progress.  A context variable so accounts run in parallel each
+# get their own, thread pools working for a run pass it on with contextvars.copy_context
+_run_metrics = contextvars.ContextVar("run_metrics", default=RunMetrics())
+
+
+def current():
+    return _run_metrics.get()
+
+
+# start a new set of metrics for a run in the current context
+def reset():
+    run_metrics = RunMetrics()
+    _run_metrics.set(run_metrics)
+    return run_metrics
+
+
+def increment(name, value=1):
+    current().increment(name, value)
+
+
+def add_time(name, seconds):
+    current().add_time(name, seconds)
+
+
+def timer(name):
+    return current().timer(name)
+
+
+def seconds(name):
+    return current().seconds(name)
+
+
+def gauge(name, value):
+    current().gauge(name, value)
+
+
+def gauge_min(name, value):
+    current().gauge_min(name, value)
+
+
+# pass the items of an iterable through, adding the time spent waiting for each one to
+# the named timer.  Used to time pages coming off an insights cursor
+def timed_iter(items, name):
+    items = iter(items)
+    run_metrics = current()
+    while True:
+        start = time.perf_counter()
+        try:
+            item = next(items)
+        except StopIteration:
+            return
+        finally:
+            run_metrics.add_time(name, time.perf_counter() - start)
+        yield item
+
+
+# log the run's metrics as one structured record.  Cloud logging turns json_fields into
+# the jsonPayload of the log entry
+def emit(**fields):
+    record = current().record(**fields)
+    logger.info("ETL run metrics", extra={"json_fields": record})
+    return record
+
+
+# profile the block with cProfile when ETL_PROFILE is set
+@contextmanager
+def profiled(path=None):
+    path = path or profile_path
+    if not path:
+        yield
+        return
+    profile = cProfile.Profile()
+    profile.enable()
+    try:
+        yield
+    finally:
+        profile.disable()
+        profile.dump_stats(path)
+        summary = io.StringIO()
+        pstats.Stats(profile, stream=summary).sort_stats("cumulative").print_stats(20)
+        logger.info("ETL profile written to " + path + "\n" + summary.getvalue())
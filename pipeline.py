@@ -0,0 +1,29 @@
+import os
+
+# rows handed to a sink at a time.  Rows stream from the insights cursor through the
+# transform to the sink so only about this many are held in memory at once
+batch_rows = int(os.getenv("PIPELINE_BATCH_ROWS", "500"))
+
+
+# group an iterable of rows into lists of at most size rows
+def batched(rows, size=None):
+    if size is None:
+        size = batch_rows
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+# write rows to a sink batch by batch, returns the number of rows written.  The caller
+# closes the sink
+def load(rows, sink, size=None):
+    count = 0
+    for batch in batched(rows, size):
+        sink.write(batch)
+        count = count + len(batch)
+    return count
@@ -0,0 +1,241 @@
+import contextvars
+import functools
+import logging
+import os
+import random
+import threading
+import time
+
+import requests
+from facebook_business.exceptions import FacebookRequestError
+from google.api_core import exceptions as google_exceptions
+
+import fetch_executor
+import metrics
+
+logger = logging.getLogger()
+
+# attempts per call, including the first
+max_attempts = int(os.getenv("RETRY_MAX_ATTEMPTS", "6"))
+# backoff before the nth retry is a random time up to base * 2^n seconds, capped at max
+backoff_base_seconds = float(os.getenv("RETRY_BASE_SECONDS", "2"))
+backoff_max_seconds = float(os.getenv("RETRY_MAX_SECONDS", "120"))
+# retries allowed across every call of one account's run, so a bad day gives up well
+# before the function times out
+retry_budget = int(os.getenv("RETRY_BUDGET", "30"))
+# consecutive failed calls after which a service's circuit opens, and the seconds it
+# stays open before one trial call is let through
+breaker_failures = int(os.getenv("BREAKER_FAILURES", "5"))
+breaker_reset_seconds = float(os.getenv("BREAKER_RESET_SECONDS", "60"))
+
+# Graph API error codes for rate limiting: app, user, page, custom and business use case
+graph_throttle_codes = {4, 17, 32, 613}
+# reasons bigquery gives for errors that go away on their own
+bigquery_transient_reasons = {"backendError", "internalError", "rateLimitExceeded"}
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+# stops calls to a service after it has failed breaker_failures times in a row.  After
+# reset_seconds one call is let through, closing the circuit again if it works
+class CircuitBreaker:
+    def __init__(self, name, failures=None, reset_seconds=None):
+        self.name = name
+        self.failures = failures or breaker_failures
+        self.reset_seconds = (
+            breaker_reset_seconds if reset_seconds is None else reset_seconds
+        )
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self.trial_running = False
+        self.lock = threading.Lock()
+
+    def before_call(self):
+        with self.lock:
+            if self.opened_at is None:
+                return
+            if (
+                self.trial_running
+                or time.monotonic() - self.opened_at < self.reset_seconds
+            ):
+                raise CircuitOpenError(self.name + " circuit is open")
+            self.trial_running = True
+
+    def record_success(self):
+        with self.lock:
+            self.consecutive_failures = 0
+            self.opened_at = None
+            self.trial_running = False
+
+    def record_failure(self):
+        with self.lock:
+            self.consecutive_failures = self.consecutive_failures + 1
+            self.trial_running = False
+            if self.opened_at is not None or self.consecutive_failures >= self.failures:
+                if self.opened_at is None:
+                    logger.error(self.name + " circuit opened")
+                    metrics.increment("circuit_opened")
+                self.opened_at = time.monotonic()
+
+
+# retries left for a run, shared by every thread working on it
+class RetryBudget:
+    def __init__(self, retries=None):
+        self.remaining = retry_budget if retries is None else retries
+        self.lock = threading.Lock()
+
+    def take(self):
+        with self.lock:
+            if self.remaining <= 0:
+                return False
+            self.remaining = self.remaining - 1
+            return True
+
+
+# breakers are per process, an outage affects every account alike
+breakers = {}
+_breakers_lock = threading.Lock()
+
+# the retry budget of the run in progress, see metrics for how contexts are passed on
+_budget = contextvars.ContextVar("retry_budget", default=RetryBudget())
+
+
+def get_breaker(service):
+    with _breakers_lock:
+        if service not in breakers:
+            breakers[service] = CircuitBreaker(service)
+        return breakers[service]
+
+
+# start a new retry budget for a run in the current context
+def reset_budget(retries=None):
+    budget = RetryBudget(retries)
+    _budget.set(budget)
+    return budget
+
+
+# take a retry from the run's budget, False once it is used up
+def take_retry(service):
+    if _budget.get().take():
+        return True
+    logger.error("Retry budget used up, giving up on " + service)
+    metrics.increment("retry_budget_exhausted")
+    return False
+
+
+# whether an error is worth retrying: throttling, server errors and dropped connections
+def is_transient(error):
+    if isinstance(error, FacebookRequestError):
+        code = error.api_error_code()
+        return (
+            error.api_transient_error()
+            or code in graph_throttle_codes
+            or (code is not None and 80000 <= code <= 80014)
+            or (error.http_status() or 0) >= 500
+        )
+    if isinstance(
+        error,
+        (
+            google_exceptions.TooManyRequests,
+            google_exceptions.ServerError,
+            requests.ConnectionError,
+            requests.Timeout,
+            ConnectionError,
+            TimeoutError,
+        ),
+    ):
+        return True
+    if isinstance(error, google_exceptions.GoogleAPICallError):
+        reasons = {item.get("reason") for item in error.errors or []}
+        return bool(reasons & bigquery_transient_reasons)
+    return False
+
+
+# seconds to wait before retry number attempt.  Full jitter so parallel callers spread
+# out, and never less than the time facebook says it needs to regain access
+def backoff_seconds(attempt, error=None):
+    delay = random.uniform(
+        0, min(backoff_max_seconds, backoff_base_seconds * 2**attempt)
+    )
+    if isinstance(error, FacebookRequestError):
+        usage, regain_seconds = fetch_executor.get_usage(error.http_headers())
+        delay = max(delay, min(regain_seconds, backoff_max_seconds * 5))
+    return delay
+
+
+# call fn, retrying transient errors (and the extra retry_on error types) with jittered
+# backoff while the run's retry budget lasts.  Calls fail straight away with
+# CircuitOpenError while the service's circuit is open
+def call(service, fn, *args, retry_on=(), attempts=None, **kwargs):
+    attempts = attempts or max_attempts
+    breaker = get_breaker(service)
+    attempt = 0
+    while True:
+        breaker.before_call()
+        try:
+            result = fn(*args, **kwargs)
+        except Exception as e:
+            if not (is_transient(e) or isinstance(e, retry_on)):
+                breaker.record_success()
+                raise
+            breaker.record_failure()
+            attempt = attempt + 1
+            if attempt >= attempts:
+                raise
+            if not take_retry(service):
+                raise
+            delay = backoff_seconds(attempt, e)
+            logger.warning(
+                "{} call failed, retry {} in {:.1f}s: {}".format(
+                    service, attempt, delay, e
+                )
+            )
+            metrics.increment("retries")
+            with metrics.timer("retry_wait"):
+                time.sleep(delay)
+            continue
+        breaker.record_success()
+        return result
+
+
+# decorator form of call
+def retrying(service, **options):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            return call(service, fn, *args, **options, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+# iterate a facebook_business Cursor, retrying the page requests it makes as it is
+# consumed.  A failed page request leaves the cursor where it was so it can be asked
+# again.  With an executor (see fetch_executor.py) every page request waits for the rate
+# limit and reports its usage headers.  Not for generators, which are finished once they
+# raise
+def iter_retrying(service, cursor, executor=None):
+    items = iter(cursor)
+
+    def next_item(items):
+        return call(service, next, items, None)
+
+    while True:
+        if executor is not None and needs_page(cursor):
+            item = executor.run(next_item, items)
+            executor.record_usage(cursor.headers())
+        else:
+            item = next_item(items)
+        if item is None:
+            return
+        yield item
+
+
+# whether the next item of a facebook_business Cursor comes with a page request
+def needs_page(cursor):
+    return not getattr(cursor, "_queue", True) and not getattr(
+        cursor, "_finished_iteration", True
+    )
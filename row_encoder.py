@@ -0,0 +1,101 @@
+import datetime
+import json
+
+try:
+    import orjson
+except ImportError:
+    # the standard library encoder does the same, only slower
+    orjson = None
+
+
+class RowSchemaError(ValueError):
+    pass
+
+
+def to_integer(value):
+    return value if type(value) is int else int(value)
+
+
+def to_float(value):
+    return value if type(value) is float else float(value)
+
+
+def to_boolean(value):
+    if isinstance(value, str):
+        return value.lower() == "true"
+    return bool(value)
+
+
+def to_text(value):
+    if isinstance(value, (datetime.date, datetime.datetime)):
+        return value.isoformat()
+    return value if type(value) is str else str(value)
+
+
+converters = {
+    "INTEGER": to_integer,
+    "INT64": to_integer,
+    "FLOAT": to_float,
+    "FLOAT64": to_float,
+    "NUMERIC": to_float,
+    "BOOLEAN": to_boolean,
+    "BOOL": to_boolean,
+}
+
+
+# the function turning a value into what a field holds.  Numbers the api sends as strings
+# become json numbers, everything else that isn't a number or bool is sent as text
+def compile_field(field):
+    if field.field_type in ("RECORD", "STRUCT"):
+        convert = RowSchema(field.fields).coerce
+    else:
+        convert = converters.get(field.field_type, to_text)
+    if field.mode == "REPEATED":
+        return lambda values: [convert(value) for value in values]
+    return convert
+
+
+# a bigquery schema compiled once into a converter per field.  coerce checks a row has no
+# fields the table doesn't, converts its values to the field types and leaves out nulls
+# and empty repeated fields, which bigquery fills in the same way
+class RowSchema:
+    def __init__(self, bq_schema):
+        self.fields = [(field.name, compile_field(field)) for field in bq_schema]
+        self.names = {field.name for field in bq_schema}
+
+    def coerce(self, row):
+        unknown = row.keys() - self.names
+        if unknown:
+            raise RowSchemaError("Unknown fields " + ", ".join(sorted(unknown)))
+        coerced = {}
+        for name, convert in self.fields:
+            value = row.get(name)
+            if value is None or value == []:
+                continue
+            try:
+                coerced[name] = convert(value)
+            except (TypeError, ValueError) as e:
+                raise RowSchemaError(
+                    "Bad value for {}: {!r}".format(name, value)
+                ) from e
+        return coerced
+
+    # the rows that could be coerced, and (row, error) for those that couldn't
+    def coerce_rows(self, rows):
+        coerced = []
+        rejected = []
+        for row in rows:
+            try:
+                coerced.append(self.coerce(row))
+            except RowSchemaError as e:
+                rejected.append((row, e))
+        return coerced, rejected
+
+
+# rows as newline delimited json bytes
+def encode_rows(rows):
+    if orjson is not None:
+        option = orjson.OPT_APPEND_NEWLINE
+        return b"".join([orjson.dumps(row, option=option) for row in rows])
+    lines = [json.dumps(row, default=str) + "\n" for row in rows]
+    return "".join(lines).encode("utf-8")
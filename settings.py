@@ -1,21 +1,63 @@
-import google.cloud.logging
 import logging
 import os
-from google.cloud import secretmanager
+import threading
+from collections.abc import Mapping
+from concurrent.futures import ThreadPoolExecutor
+
+import metrics
+
+# attribute name -> secret manager secret name
+secret_names = {
+    "table_id": "table_id",
+    "dataset_id": "dataset_name",
+    "fb_access_token": "fb_access_token",
+    "fb_account_id": "fb_account_id",
+    "fb_app_id": "fb_app_id",
+    "fb_app_secret": "fb_app_secret",
+    "gcp_project_id": "gcp_project_id",
+}
+
+# kept for the life of the process so warm cloud function invocations reuse them
+_secrets = None
+_secrets_lock = threading.Lock()
+_logger = None
+
+
+# the secrets are only fetched the first time one of them is read, so importing a module
+# that calls get_secrets costs nothing
+class LazySecrets(Mapping):
+    def __getitem__(self, key):
+        return load_secrets()[key]
+
+    def __iter__(self):
+        return iter(secret_names)
+
+    def __len__(self):
+        return len(secret_names)
 
 
 def get_secrets():
-    client = secretmanager.SecretManagerServiceClient()
-    attributes = {
-        "table_id": get_secret(client, "table_id"),
-        "dataset_id": get_secret(client, "dataset_name"),
-        "fb_access_token": get_secret(client, "fb_access_token"),
-        "fb_account_id": get_secret(client, "fb_account_id"),
-        "fb_app_id": get_secret(client, "fb_app_id"),
-        "fb_app_secret": get_secret(client, "fb_app_secret"),
-        "gcp_project_id": get_secret(client, "gcp_project_id"),
-    }
-    return attributes
+    return LazySecrets()
+
+
+# fetch every secret at once, in parallel, the first time it's called
+def load_secrets():
+    global _secrets
+    if _secrets is None:
+        with _secrets_lock:
+            if _secrets is None:
+                # imported here, clients imports the google cloud libraries
+                import clients
+
+                with metrics.timer("secret_fetch"):
+                    client = clients.secret_manager_client()
+                    with ThreadPoolExecutor(max_workers=len(secret_names)) as pool:
+                        values = pool.map(
+                            lambda secret: get_secret(client, secret),
+                            secret_names.values(),
+                        )
+                        _secrets = dict(zip(secret_names, values))
+    return _secrets
 
 
 def get_secret(client, secret):
@@ -24,7 +66,14 @@ def get_secret(client, secret):
     return response.payload.data.decode("UTF-8")
 
 
+# set up cloud logging once per process, every module calling this shares the logger
 def init_logging():
+    global _logger
+    if _logger is not None:
+        return _logger
+
+    import google.cloud.logging
+
     logging_client = google.cloud.logging.Client()
     logging_client.setup_logging(log_level=logging.DEBUG)
     logging_client.setup_logging()
@@ -33,4 +82,5 @@ def init_logging():
     if os.getenv("LOCAL_LOGGING", "False") == "True":
         # output logs to console - otherwise logs are only visible when running in GCP
         logger.addHandler(logging.StreamHandler())
+    _logger = logger
     return logger
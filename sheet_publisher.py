@@ -0,0 +1,129 @@
+import os
+
+from gspread.utils import rowcol_to_a1
+
+# cells sent in one values batchUpdate call.  Sheets rejects requests over about 10MB,
+# this keeps well under that
+max_batch_cells = int(os.getenv("SHEETS_BATCH_CELLS", "50000"))
+
+
+# a cell as the string get_all_values returns for it
+def cell_text(value):
+    if value is None:
+        return ""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+# where each row goes on the sheet, as indexes into rows with None for a blank row.
+# Every key stays on the row it is on now so an unchanged row is not rewritten.  New keys
+# take the rows of keys that are gone, then go to the end.  Rows of keys that are gone
+# and not taken are left blank, the rows below them stay where they are
+def plan_rows(current, rows, key_index):
+    new_rows = {row[key_index]: index for index, row in enumerate(rows)}
+    slots = []
+    for row in current:
+        key = row[key_index] if len(row) > key_index else ""
+        slots.append(key if key in new_rows else None)
+    placed = {key for key in slots if key is not None}
+    added = [key for key in new_rows if key not in placed]
+    for i, key in enumerate(slots):
+        if key is None and added:
+            slots[i] = added.pop(0)
+    slots.extend(added)
+    while slots and slots[-1] is None:
+        slots.pop()
+    return [None if key is None else new_rows[key] for key in slots]
+
+
+# the runs of consecutive rows that differ between current and wanted, as (first row
+# index, rows).  wanted holds the rows as cell text to compare with the sheet, send the
+# values written for them, wanted itself by default.  Rows the sheet no longer needs are
+# blanked
+def changed_ranges(current, wanted, width, send=None):
+    if send is None:
+        send = wanted
+    blank = [""] * width
+    ranges = []
+    run_start = None
+    run_values = []
+    for i in range(max(len(current), len(wanted))):
+        row = wanted[i] if i < len(wanted) else blank
+        old_row = current[i] if i < len(current) else []
+        old_row = (list(old_row) + blank)[:width]
+        if row != old_row:
+            if run_start is None:
+                run_start = i
+            run_values.append(send[i] if i < len(send) else blank)
+            continue
+        if run_start is not None:
+            ranges.append((run_start, run_values))
+            run_start = None
+            run_values = []
+    if run_start is not None:
+        ranges.append((run_start, run_values))
+    return ranges
+
+
+def sheet_range(start, values, width):
+    first = rowcol_to_a1(start + 1, 1)
+    last = rowcol_to_a1(start + len(values), width)
+    return {"range": first + ":" + last, "values": values}
+
+
+# batchUpdate data for the changed runs, split into calls of at most max_cells cells.  A
+# run that is too big on its own is split by rows
+def chunk_ranges(ranges, width, max_cells=None):
+    if max_cells is None:
+        max_cells = max_batch_cells
+    max_rows = max(1, max_cells // width)
+    batch = []
+    cells = 0
+    for start, values in ranges:
+        for offset in range(0, len(values), max_rows):
+            part = values[offset : offset + max_rows]
+            if batch and cells + len(part) * width > max_cells:
+                yield batch
+                batch = []
+                cells = 0
+            batch.append(sheet_range(start + offset, part, width))
+            cells = cells + len(part) * width
+    if batch:
+        yield batch
+
+
+# write data_frame to the worksheet, sending only the rows that changed since the last
+# publish.  Rows are matched to the sheet by key_column and compared as the text the
+# sheet shows, the frame's own values are sent so numbers stay numbers.  The sheet is
+# rewritten in full only when its header differs from the frame's columns.  Returns the
+# number of batchUpdate calls made
+def publish(worksheet, data_frame, key_column, max_cells=None):
+    header = [cell_text(column) for column in data_frame.columns]
+    values = data_frame.values.tolist()
+    rows = [[cell_text(value) for value in row] for row in values]
+    width = len(header)
+    key_index = header.index(key_column)
+
+    current = worksheet.get_all_values()
+    if current and current[0][:width] == header:
+        blank = [""] * width
+        order = plan_rows(current[1:], rows, key_index)
+        wanted = [header] + [blank if i is None else rows[i] for i in order]
+        send = [header] + [blank if i is None else values[i] for i in order]
+    else:
+        wanted = [header] + rows
+        send = [header] + values
+        # blank any columns left over from an older layout
+        old_width = max((len(row) for row in current), default=0)
+        if old_width > width:
+            wanted = [row + [""] * (old_width - width) for row in wanted]
+            send = [row + [""] * (old_width - width) for row in send]
+            width = old_width
+
+    ranges = changed_ranges(current, wanted, width, send)
+    calls = 0
+    for batch in chunk_ranges(ranges, width, max_cells):
+        worksheet.batch_update(batch)
+        calls = calls + 1
+    return calls
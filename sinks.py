@@ -0,0 +1,468 @@
+import datetime
+import gzip
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+import uuid
+
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.parquet as pq
+from google.cloud import bigquery
+from google.cloud.exceptions import NotFound
+
+import metrics
+import resilience
+import row_encoder
+import table_layout
+
+logger = logging.getLogger()
+
+# load (batch load jobs), streaming (insert_rows_json) or auto, which streams runs of up to
+# streaming_max_rows rows and uses load jobs for anything larger
+bigquery_sink_mode = os.getenv("BQ_SINK", "auto")
+# uncompressed bytes of rows buffered before a load job is started
+load_chunk_bytes = int(os.getenv("BQ_LOAD_CHUNK_BYTES", str(256 * 1024 * 1024)))
+load_chunk_rows = int(os.getenv("BQ_LOAD_CHUNK_ROWS", "1000000"))
+streaming_max_rows = int(os.getenv("BQ_STREAMING_MAX_ROWS", "1000"))
+# gzip level of newline delimited json load files, 0 sends them uncompressed
+load_gzip_level = int(os.getenv("BQ_LOAD_GZIP_LEVEL", "6"))
+# append adds rows to the table.  replace stages the rows and swaps out every day they
+# cover for the campaigns in them, merge stages them and upserts on (data_date_start,
+# campaign_id).  Both make re-fetching a day safe without touching other accounts' rows,
+# they always load through a staging table
+bigquery_write_mode = os.getenv("BQ_WRITE_MODE", "replace")
+merge_keys = ["data_date_start", "campaign_id"]
+# accounts imported in parallel take turns applying their staged rows, concurrent dml
+# on one table can abort each other
+apply_lock = threading.Lock()
+# rows per insert_rows_json request, keeps requests under the streaming size limits
+streaming_chunk_rows = 500
+# rows of each streamed chunk encoded to estimate the bytes sent for the whole chunk,
+# insert_rows_json encodes the rows itself
+size_sample_rows = 10
+
+
+# insert errors for rows that were fine but not written, because another row in the
+# request was invalid or bigquery had a passing problem
+replayable_reasons = {"stopped", "backendError", "internalError", "timeout"}
+
+
+class RejectedRowsError(Exception):
+    pass
+
+
+# stream rows into a table in chunks.  Rows bigquery reports errors for are sent again on
+# their own when the error was not theirs, rows it rejects are logged and returned.  Row
+# ids stay the same across retries so bigquery can drop duplicates
+def insert_rows_bigquery(client, table_ref, data):
+    table = resilience.call("bigquery", client.get_table, table_ref)
+    rejected = []
+    for start in range(0, len(data), streaming_chunk_rows):
+        chunk = data[start : start + streaming_chunk_rows]
+        row_ids = [uuid.uuid4().hex for row in chunk]
+        sample = chunk[:size_sample_rows]
+        row_bytes = len(row_encoder.encode_rows(sample)) / max(1, len(sample))
+        attempt = 0
+        while chunk:
+            metrics.increment("bq_bytes_sent", int(row_bytes * len(chunk)))
+            with metrics.timer("bq_insert"):
+                errors = resilience.call(
+                    "bigquery",
+                    client.insert_rows_json,
+                    json_rows=chunk,
+                    table=table,
+                    row_ids=row_ids,
+                    retry_on=(NotFound,),
+                )
+            replay = []
+            for error in errors:
+                row = chunk[error["index"]]
+                reasons = {item.get("reason") for item in error["errors"]}
+                if reasons <= replayable_reasons:
+                    replay.append(error["index"])
+                    continue
+                logger.error(
+                    "Row rejected by table {}: {} {}".format(
+                        table.table_id, error["errors"], json.dumps(row)
+                    )
+                )
+                rejected.append(row)
+
+            attempt = attempt + 1
+            if replay and attempt >= resilience.max_attempts:
+                logger.error("Giving up on {} rows".format(len(replay)))
+                rejected.extend(chunk[index] for index in replay)
+                break
+            if replay:
+                metrics.increment("bq_rows_replayed", len(replay))
+                time.sleep(resilience.backoff_seconds(attempt))
+            chunk = [chunk[index] for index in replay]
+            row_ids = [row_ids[index] for index in replay]
+        logger.info("Success uploaded to table {}".format(table.table_id))
+    metrics.increment("bq_rows_rejected", len(rejected))
+    return rejected
+
+
+# arrow record batches from the columnar transform can be written to any sink in place of
+# a list of row dicts
+def is_record_batch(rows):
+    return isinstance(rows, pa.RecordBatch)
+
+
+# the rows of a record batch as json friendly dicts, dates and timestamps as strings
+def json_rows(batch):
+    fields = [
+        pa.field(field.name, pa.string()) if pa.types.is_temporal(field.type) else field
+        for field in batch.schema
+    ]
+    return batch.cast(pa.schema(fields)).to_pylist()
+
+
+# writes rows to a bigquery table.  In load mode rows are buffered in a temp file and
+# written with a load job every load_chunk_bytes or load_chunk_rows rows instead of a
+# streaming insert per call to write.  Row dicts are buffered as (gzipped) newline
+# delimited json, arrow record batches as parquet.  With a row schema (see row_encoder.py)
+# row dicts are checked and converted to the column types before they are sent, rows
+# that don't fit are rejected.  With the replace and merge write modes the load
+# jobs go to a staging table that is applied to the destination on close.  Call close to
+# write the remaining rows
+class BigQuerySink:
+    def __init__(
+        self,
+        client,
+        table_ref,
+        mode=None,
+        chunk_bytes=None,
+        chunk_rows=None,
+        max_stream=None,
+        write_mode=None,
+        row_schema=None,
+    ):
+        self.client = client
+        self.row_schema = row_schema
+        self.table_ref = table_ref
+        self.write_mode = write_mode or bigquery_write_mode
+        self.mode = mode or bigquery_sink_mode
+        self.staging_ref = None
+        if self.write_mode != "append":
+            self.mode = "load"
+            self.staging_ref = "{}_staging_{}".format(table_ref, uuid.uuid4().hex[:12])
+        self.chunk_bytes = chunk_bytes or load_chunk_bytes
+        self.chunk_rows = chunk_rows or load_chunk_rows
+        self.max_stream = streaming_max_rows if max_stream is None else max_stream
+        self.small_writes = []
+        self.small_rows = 0
+        self.buffer_file = None
+        self.buffer = None
+        self.buffer_format = None
+        self.buffered_bytes = 0
+        self.buffered_rows = 0
+        self.rows_written = 0
+        self.rows_rejected = 0
+        self.load_jobs = 0
+
+    def write(self, rows):
+        if self.mode == "streaming":
+            self.stream(rows)
+            return
+
+        writes = [rows]
+        if self.mode == "auto":
+            self.small_writes.append(rows)
+            self.small_rows = self.small_rows + len(rows)
+            if self.small_rows <= self.max_stream:
+                return
+            # too big for streaming, switch to load jobs for the rest of the run
+            writes = self.small_writes
+            self.small_writes = []
+            self.mode = "load"
+
+        for rows in writes:
+            if is_record_batch(rows):
+                self.buffer_batch(rows)
+            else:
+                self.buffer_rows(rows)
+
+    def stream(self, rows):
+        if is_record_batch(rows):
+            rows = json_rows(rows)
+        elif self.row_schema is not None:
+            rows = self.coerce_rows(rows)
+        rejected = insert_rows_bigquery(self.client, self.table_ref, rows)
+        self.rows_rejected = self.rows_rejected + len(rejected)
+        self.rows_written = self.rows_written + len(rows) - len(rejected)
+
+    def buffer_rows(self, rows):
+        if self.buffer is None:
+            self.buffer_file = tempfile.TemporaryFile()
+            self.buffer = self.buffer_file
+            if load_gzip_level:
+                self.buffer = gzip.GzipFile(
+                    fileobj=self.buffer_file, mode="wb", compresslevel=load_gzip_level
+                )
+            self.buffer_format = bigquery.SourceFormat.NEWLINE_DELIMITED_JSON
+        if self.row_schema is not None:
+            rows = self.coerce_rows(rows)
+        data = row_encoder.encode_rows(rows)
+        self.buffer.write(data)
+        self.buffered(len(data), len(rows))
+
+    # rows converted to the column types.  Rows that don't fit the table are logged and
+    # counted as rejected, like the rows bigquery rejects
+    def coerce_rows(self, rows):
+        rows, rejected = self.row_schema.coerce_rows(rows)
+        for row, error in rejected:
+            logger.error(
+                "Row rejected by table {}: {} {}".format(
+                    self.table_ref, error, json.dumps(row, default=str)
+                )
+            )
+        metrics.increment("bq_rows_rejected", len(rejected))
+        self.rows_rejected = self.rows_rejected + len(rejected)
+        return rows
+
+    def buffer_batch(self, batch):
+        if self.buffer is None:
+            self.buffer_file = tempfile.TemporaryFile()
+            self.buffer = pq.ParquetWriter(
+                self.buffer_file, batch.schema, compression="snappy"
+            )
+            self.buffer_format = bigquery.SourceFormat.PARQUET
+        self.buffer.write_batch(batch)
+        self.buffered(batch.nbytes, batch.num_rows)
+
+    def buffered(self, size, rows):
+        self.buffered_bytes = self.buffered_bytes + size
+        self.buffered_rows = self.buffered_rows + rows
+        if (
+            self.buffered_bytes >= self.chunk_bytes
+            or self.buffered_rows >= self.chunk_rows
+        ):
+            self.flush()
+
+    # start a load job for the buffered rows and wait for it to finish
+    def flush(self):
+        if self.buffer is None:
+            return
+        if self.buffer is not self.buffer_file:
+            self.buffer.close()
+        metrics.increment("bq_bytes_sent", self.buffer_file.tell())
+        self.buffer_file.seek(0)
+        job_config = bigquery.LoadJobConfig(
+            source_format=self.buffer_format,
+            write_disposition=bigquery.WriteDisposition.WRITE_APPEND,
+        )
+        if self.buffer_format == bigquery.SourceFormat.PARQUET:
+            # load list<struct> columns as repeated records
+            parquet_options = bigquery.ParquetOptions()
+            parquet_options.enable_list_inference = True
+            job_config.parquet_options = parquet_options
+        destination = self.table_ref
+        if self.staging_ref is not None:
+            destination = self.staging_ref
+            if self.load_jobs == 0:
+                self.create_staging_table()
+
+        # load jobs are all or nothing, a failed one can be sent again
+        def load():
+            self.buffer_file.seek(0)
+            job = self.client.load_table_from_file(
+                self.buffer_file, destination, job_config=job_config
+            )
+            return job.result()
+
+        try:
+            with metrics.timer("bq_load_job"):
+                resilience.call("bigquery", load)
+        finally:
+            self.buffer_file.close()
+            self.buffer_file = None
+            self.buffer = None
+        logger.info(
+            "Loaded {} rows into table {}".format(self.buffered_rows, destination)
+        )
+        self.rows_written = self.rows_written + self.buffered_rows
+        self.load_jobs = self.load_jobs + 1
+        self.buffered_bytes = 0
+        self.buffered_rows = 0
+
+    # staging table with the destination's schema that expires on its own in case the run
+    # dies before the staged rows are applied
+    def create_staging_table(self):
+        target = self.client.get_table(self.table_ref)
+        staging = bigquery.Table(self.staging_ref, schema=target.schema)
+        expires = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(
+            days=1
+        )
+        staging.expires = expires
+        self.client.create_table(staging, exists_ok=True)
+
+    # apply the staged rows to the destination in one transaction.  The staged date range
+    # is read into variables first, a constant filter on the partition column lets
+    # bigquery skip every partition outside it
+    def apply_staged_rows(self):
+        on = " and ".join("t.{0} = s.{0}".format(key) for key in merge_keys)
+        staged_days = f"""
+            declare staged_since date default (
+                select min(data_date_start) from `{self.staging_ref}`);
+            declare staged_until date default (
+                select max(data_date_start) from `{self.staging_ref}`);
+        """
+        in_staged_days = "t.data_date_start between staged_since and staged_until"
+        if self.write_mode == "merge":
+            columns = [
+                field.name for field in self.client.get_table(self.table_ref).schema
+            ]
+            updates = ", ".join("{0} = s.{0}".format(column) for column in columns)
+            sql_query = f"""
+                {staged_days}
+                merge `{self.table_ref}` t
+                using `{self.staging_ref}` s
+                on {on} and {in_staged_days}
+                when matched then update set {updates}
+                when not matched then insert row
+            """
+        else:
+            sql_query = f"""
+                {staged_days}
+                begin transaction;
+                delete from `{self.table_ref}` t
+                where {in_staged_days}
+                    and exists (select 1 from `{self.staging_ref}` s where {on});
+                insert into `{self.table_ref}` select * from `{self.staging_ref}`;
+                commit transaction;
+            """
+        try:
+            with apply_lock, metrics.timer("bq_apply_staged"):
+                query_job = resilience.call("bigquery", self.run_query, sql_query)
+            metrics.increment("bq_bytes_scanned", query_job.total_bytes_processed or 0)
+        finally:
+            self.client.delete_table(self.staging_ref, not_found_ok=True)
+        logger.info(
+            "Applied {} staged rows to table {} ({})".format(
+                self.rows_written, self.table_ref, self.write_mode
+            )
+        )
+
+    # the statement runs as one transaction, a failed one can be run again
+    def run_query(self, sql_query):
+        query_job = table_layout.query(self.client, sql_query)
+        query_job.result()
+        return query_job
+
+    # raises RejectedRowsError after writing everything else if bigquery refused any rows,
+    # so the run fails instead of quietly losing them
+    def close(self):
+        for rows in self.small_writes:
+            self.stream(rows)
+        self.small_writes = []
+        self.flush()
+        if self.staging_ref is not None and self.rows_written > 0:
+            self.apply_staged_rows()
+        if self.rows_rejected:
+            raise RejectedRowsError(
+                "{} rows rejected by table {}".format(
+                    self.rows_rejected, self.table_ref
+                )
+            )
+        return self.rows_written
+
+
+# writes rows to a local newline delimited json file, gzipped when the path ends in .gz
+class NdjsonFileSink:
+    def __init__(self, path):
+        self.path = path
+        if path.endswith(".gz"):
+            self.file = gzip.open(path, "wb")
+        else:
+            self.file = open(path, "wb")
+        self.rows_written = 0
+
+    def write(self, rows):
+        if is_record_batch(rows):
+            rows = json_rows(rows)
+        self.file.write(row_encoder.encode_rows(rows))
+        self.rows_written = self.rows_written + len(rows)
+
+    def close(self):
+        self.file.close()
+        return self.rows_written
+
+
+arrow_types = {
+    "STRING": "string",
+    "INTEGER": "int64",
+    "INT64": "int64",
+    "FLOAT": "float64",
+    "FLOAT64": "float64",
+    "NUMERIC": "float64",
+    "BOOLEAN": "bool",
+    "BOOL": "bool",
+    "DATE": "date32",
+    "TIMESTAMP": "timestamp",
+    "DATETIME": "datetime",
+}
+
+
+# the arrow schema matching a list of bigquery schema fields
+def arrow_schema(bq_schema):
+    def arrow_type(field):
+        if field.field_type in ("RECORD", "STRUCT"):
+            data_type = pa.struct([(f.name, arrow_type(f)) for f in field.fields])
+        elif arrow_types[field.field_type] == "timestamp":
+            # a timestamp with a time zone loads as TIMESTAMP, without one as DATETIME
+            data_type = pa.timestamp("us", tz="UTC")
+        elif arrow_types[field.field_type] == "datetime":
+            data_type = pa.timestamp("us")
+        else:
+            data_type = getattr(pa, arrow_types[field.field_type])()
+        if field.mode == "REPEATED":
+            return pa.list_(data_type)
+        return data_type
+
+    return pa.schema([(field.name, arrow_type(field)) for field in bq_schema])
+
+
+# a table of row dicts cast to the types of schema.  Timestamp strings without an offset,
+# as the row transform writes date_inserted, are read as UTC
+def cast_table(table, schema):
+    columns = []
+    for field in schema:
+        column = table.column(field.name)
+        if (
+            pa.types.is_timestamp(field.type)
+            and field.type.tz is not None
+            and pa.types.is_string(column.type)
+        ):
+            column = column.cast(pa.timestamp(field.type.unit))
+            column = pc.assume_timezone(column, field.type.tz)
+        columns.append(column.cast(field.type))
+    return pa.Table.from_arrays(columns, schema=schema)
+
+
+# writes rows to a local parquet file with the column types of a bigquery schema
+class ParquetFileSink:
+    def __init__(self, path, bq_schema):
+        self.schema = arrow_schema(bq_schema)
+        self.writer = pq.ParquetWriter(path, self.schema, compression="snappy")
+        self.rows_written = 0
+
+    def write(self, rows):
+        if not len(rows):
+            return
+        if is_record_batch(rows):
+            # already typed by the columnar transform
+            self.writer.write_batch(rows)
+        else:
+            # strings from the api are parsed into the schema types by the cast
+            table = pa.Table.from_pylist(rows)
+            self.writer.write_table(cast_table(table, self.schema))
+        self.rows_written = self.rows_written + len(rows)
+
+    def close(self):
+        self.writer.close()
+        return self.rows_written
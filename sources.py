@@ -0,0 +1,64 @@
+import json
+
+# A source provides the two things the etl reads from facebook:
+#   get_campaign_index() -> {campaign_id: campaign fields}
+#   fetch_insights(time_ranges) -> (time range, insight rows) for each time range
+# facebook.GraphSource reads them from the Graph API, the sources here replay recordings
+# so the pipeline can run without live services
+
+
+def export_row(row):
+    if hasattr(row, "export_all_data"):
+        return row.export_all_data()
+    return dict(row)
+
+
+# serves campaigns and insights from a json fixture recorded by RecordingSource, in the
+# form {"campaigns": {campaign_id: {...}}, "insights": [{...}, ...]}
+class FixtureSource:
+    def __init__(self, path=None, fixture=None):
+        if fixture is None:
+            with open(path) as f:
+                fixture = json.load(f)
+        self.campaigns = fixture.get("campaigns", {})
+        self.insights = fixture.get("insights", [])
+
+    def get_campaign_index(self):
+        return self.campaigns
+
+    def fetch_insights(self, time_ranges):
+        for timerange in time_ranges:
+            rows = (
+                row
+                for row in self.insights
+                if timerange["since"] <= row.get("date_start") <= timerange["until"]
+            )
+            yield timerange, rows
+
+
+# passes another source through and writes everything it returned to a fixture for
+# FixtureSource once the insights have all been read
+class RecordingSource:
+    def __init__(self, source, path):
+        self.source = source
+        self.path = path
+        self.campaigns = {}
+        self.insights = []
+
+    def get_campaign_index(self):
+        self.campaigns = self.source.get_campaign_index()
+        return self.campaigns
+
+    def fetch_insights(self, time_ranges):
+        for timerange, rows in self.source.fetch_insights(time_ranges):
+            yield timerange, self.record(rows)
+        self.save()
+
+    def record(self, rows):
+        for row in rows:
+            self.insights.append(export_row(row))
+            yield row
+
+    def save(self):
+        with open(self.path, "w") as f:
+            json.dump({"campaigns": self.campaigns, "insights": self.insights}, f)
@@ -0,0 +1,141 @@
+import json
+import os
+import tempfile
+import threading
+from contextlib import contextmanager
+
+from google.cloud import bigquery
+from google.cloud.exceptions import NotFound
+
+import metrics
+import table_layout
+
+# The small bits of state the etl keeps between runs (watermarks, campaign snapshots,
+# fingerprints, backfill checkpoints) live either in a local json file or in a bigquery
+# table next to the destination table.  These are the two places, the modules keep the
+# shape of what they store
+
+# one lock per file, every store on the same file takes turns writing it
+_file_locks = {}
+_file_locks_lock = threading.Lock()
+# one merge into a table at a time, see sinks.apply_lock
+_table_locks = {}
+_table_locks_lock = threading.Lock()
+
+# query parameter types of the schema field types used by the stores
+parameter_types = {"FLOAT": "FLOAT64", "INTEGER": "INT64", "BOOLEAN": "BOOL"}
+
+
+def get_lock(locks, locks_lock, key):
+    with locks_lock:
+        return locks.setdefault(key, threading.Lock())
+
+
+# a dict kept in a json file.  Without a path nothing is read or written.  Writes go to a
+# temp file that replaces the file, a crash leaves the old contents
+class JsonFile:
+    def __init__(self, path):
+        self.path = path
+
+    def read(self):
+        if not self.path or not os.path.exists(self.path):
+            return {}
+        try:
+            with open(self.path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def write(self, stored):
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as f:
+                json.dump(stored, f)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    # the stored dict to change in place, written back when the block ends
+    @contextmanager
+    def updating(self):
+        if not self.path:
+            yield {}
+            return
+        with get_lock(_file_locks, _file_locks_lock, self.path):
+            stored = self.read()
+            yield stored
+            self.write(stored)
+
+
+# rows of a bigquery table with one row per key, e.g. per account.  get reads the row of
+# a key with a tiny query, put upserts it with a merge and creates the table the first
+# time.  An updated_at field in the schema is set to the time of the put
+class BigQueryRowStore:
+    def __init__(self, client, table_ref, schema, keys):
+        self.client = client
+        self.table_ref = table_ref
+        self.schema = schema
+        self.keys = keys
+        self.types = {
+            field.name: parameter_types.get(field.field_type, field.field_type)
+            for field in schema
+        }
+        self.fields = [
+            field.name
+            for field in schema
+            if field.name not in keys and field.name != "updated_at"
+        ]
+        self.stamped = any(field.name == "updated_at" for field in schema)
+
+    def job_config(self, values):
+        return bigquery.QueryJobConfig(
+            query_parameters=[
+                bigquery.ScalarQueryParameter(name, self.types[name], value)
+                for name, value in values.items()
+            ]
+        )
+
+    # the row of a key as a dict of its other fields, None when there is none
+    def get(self, **key):
+        condition = " and ".join("{0} = @{0}".format(name) for name in self.keys)
+        sql_query = f"""
+            select {", ".join(self.fields)}
+            FROM `{self.table_ref}`
+            where {condition}
+        """
+        try:
+            query_job = table_layout.query(self.client, sql_query, self.job_config(key))
+            rows = list(query_job.result())
+        except NotFound:
+            return None
+        metrics.increment("bq_bytes_scanned", query_job.total_bytes_processed or 0)
+        if not rows:
+            return None
+        return dict(zip(self.fields, rows[0]))
+
+    def put(self, **values):
+        table = bigquery.Table(self.table_ref, schema=self.schema)
+        self.client.create_table(table, exists_ok=True)
+        source = ", ".join("@{0} as {0}".format(name) for name in self.keys)
+        condition = " and ".join("t.{0} = s.{0}".format(name) for name in self.keys)
+        updates = ["{0} = @{0}".format(name) for name in self.fields]
+        columns = self.keys + self.fields
+        inserts = ["@" + name for name in columns]
+        if self.stamped:
+            updates.append("updated_at = current_timestamp()")
+            columns = columns + ["updated_at"]
+            inserts.append("current_timestamp()")
+        sql_query = f"""
+            merge `{self.table_ref}` t
+            using (select {source}) s
+            on {condition}
+            when matched then
+                update set {", ".join(updates)}
+            when not matched then
+                insert ({", ".join(columns)})
+                values ({", ".join(inserts)})
+        """
+        with get_lock(_table_locks, _table_locks_lock, self.table_ref):
+            table_layout.query(self.client, sql_query, self.job_config(values)).result()
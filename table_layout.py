@@ -0,0 +1,114 @@
+import logging
+import os
+
+from google.cloud import bigquery
+
+import metrics
+
+logger = logging.getLogger()
+
+# the destination table is partitioned by day on data_date_start and clustered by
+# campaign_id, so queries on a date range or on some campaigns only read those blocks
+partition_field = "data_date_start"
+cluster_fields = ["campaign_id"]
+# what to do when the destination table exists with another layout: warn or fail
+layout_check = os.getenv("BQ_LAYOUT_CHECK", "warn")
+# bytes one query may scan, estimated with a dry run before it runs, 0 skips the dry run
+query_budget_bytes = int(os.getenv("BQ_QUERY_BUDGET_BYTES", str(10 * 1024**3)))
+# warn or refuse to run queries over the budget
+query_budget_action = os.getenv("BQ_QUERY_BUDGET_ACTION", "warn")
+
+# tables already checked by this process, by table ref
+_checked_tables = {}
+
+
+class TableLayoutError(Exception):
+    pass
+
+
+class QueryBudgetError(Exception):
+    pass
+
+
+# what is wrong with a table's layout, empty when it is partitioned and clustered as it
+# should be and has every field of schema
+def layout_problems(table, schema):
+    problems = []
+    partitioning = table.time_partitioning
+    if partitioning is None or partitioning.field != partition_field:
+        problems.append("not partitioned on " + partition_field)
+    elif partitioning.type_ != bigquery.TimePartitioningType.DAY:
+        problems.append("not partitioned by day")
+    if list(table.clustering_fields or []) != cluster_fields:
+        problems.append("not clustered by " + ", ".join(cluster_fields))
+    existing = {field.name for field in table.schema}
+    missing = [field.name for field in schema if field.name not in existing]
+    if missing:
+        problems.append("missing fields " + ", ".join(missing))
+    return problems
+
+
+# statement that copies a table into a new one with the expected layout.  Partitioning
+# can't be changed in place, the copy replaces the table once it has been checked
+def migration_sql(table_ref):
+    return f"""
+        create table `{table_ref}_partitioned`
+        partition by {partition_field}
+        cluster by {", ".join(cluster_fields)}
+        as select * from `{table_ref}`
+    """
+
+
+# create the destination table with the expected layout, or check the layout of the one
+# that is there.  Checked once per process, returns the table
+def ensure_table(client, table_ref, schema):
+    if table_ref in _checked_tables:
+        return _checked_tables[table_ref]
+    table = bigquery.Table(table_ref, schema=schema)
+    table.time_partitioning = bigquery.TimePartitioning(
+        type_=bigquery.TimePartitioningType.DAY, field=partition_field
+    )
+    table.clustering_fields = cluster_fields
+    table = client.create_table(table, exists_ok=True)
+
+    problems = layout_problems(table, schema)
+    if problems:
+        message = (
+            "Table {} doesn't have the expected layout: {}.  A copy with it can be "
+            "made with: {}".format(
+                table_ref,
+                "; ".join(problems),
+                " ".join(migration_sql(table_ref).split()),
+            )
+        )
+        if layout_check == "fail":
+            raise TableLayoutError(message)
+        logger.warning(message)
+    _checked_tables[table_ref] = table
+    return table
+
+
+# start a query once a dry run shows it scans no more than the budget.  Over budget it is
+# logged, or refused with QueryBudgetError.  Returns the query job like client.query
+def query(client, sql_query, job_config=None, budget=None):
+    if budget is None:
+        budget = query_budget_bytes
+    if budget:
+        if job_config is not None:
+            dry_config = bigquery.QueryJobConfig.from_api_repr(job_config.to_api_repr())
+        else:
+            dry_config = bigquery.QueryJobConfig()
+        dry_config.dry_run = True
+        dry_config.use_query_cache = False
+        estimate = client.query(sql_query, job_config=dry_config).total_bytes_processed
+        estimate = estimate or 0
+        metrics.increment("bq_bytes_estimated", estimate)
+        if estimate > budget:
+            message = "Query would scan {} bytes, over the budget of {}: {}".format(
+                estimate, budget, " ".join(sql_query.split())
+            )
+            if query_budget_action == "refuse":
+                metrics.increment("bq_queries_refused")
+                raise QueryBudgetError(message)
+            logger.warning(message)
+    return client.query(sql_query, job_config=job_config)
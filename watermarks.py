@@ -0,0 +1,77 @@
+import datetime
+import os
+
+import pyarrow as pa
+import pyarrow.compute as pc
+from google.cloud import bigquery
+
+import state_store
+
+# bigquery keeps watermarks in a small metadata table next to the destination table, file
+# keeps them in a local json file (the local stand-in for a bucket)
+watermark_store_type = os.getenv("WATERMARK_STORE", "bigquery")
+watermark_table_id = os.getenv("WATERMARK_TABLE", "etl_watermarks")
+watermark_path = os.getenv("WATERMARK_PATH", "/tmp/watermarks.json")
+
+watermark_schema = [
+    bigquery.SchemaField("account_id", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("level", "STRING", mode="REQUIRED"),
+    bigquery.SchemaField("watermark", "DATE", mode="REQUIRED"),
+    bigquery.SchemaField("updated_at", "TIMESTAMP"),
+]
+
+
+# the latest data date loaded for each account and insights level, kept in a json file
+class FileWatermarkStore:
+    def __init__(self, path):
+        self.file = state_store.JsonFile(path)
+
+    def get(self, account_id, level):
+        day = self.file.read().get(account_id, {}).get(level)
+        if day is None:
+            return None
+        return datetime.date.fromisoformat(day)
+
+    def set(self, account_id, level, day):
+        with self.file.updating() as stored:
+            stored.setdefault(account_id, {})[level] = day.isoformat()
+
+
+# the latest data date loaded for each account and insights level, kept in a bigquery
+# table with one row per account and level so reading it is a tiny query
+class BigQueryWatermarkStore:
+    def __init__(self, client, table_ref):
+        self.rows = state_store.BigQueryRowStore(
+            client, table_ref, watermark_schema, ["account_id", "level"]
+        )
+
+    def get(self, account_id, level):
+        row = self.rows.get(account_id=account_id, level=level)
+        if row is None:
+            return None
+        return row["watermark"]
+
+    def set(self, account_id, level, day):
+        self.rows.put(account_id=account_id, level=level, watermark=day)
+
+
+def get_watermark_store(client, project_id, dataset_id):
+    if watermark_store_type == "file":
+        return FileWatermarkStore(watermark_path)
+    table_ref = "{}.{}.{}".format(project_id, dataset_id, watermark_table_id)
+    return BigQueryWatermarkStore(client, table_ref)
+
+
+# the latest data date in a batch of rows, or day if that is later.  Takes row dicts or
+# an arrow record batch with a date32 data_date_start column
+def latest_day(rows, day=None):
+    if isinstance(rows, pa.RecordBatch):
+        batch_day = pc.max(rows.column("data_date_start")).as_py()
+        if day is None or (batch_day is not None and batch_day > day):
+            day = batch_day
+        return day
+    for row in rows:
+        row_day = datetime.date.fromisoformat(row["data_date_start"])
+        if day is None or row_day > day:
+            day = row_day
+    return day
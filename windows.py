@@ -0,0 +1,47 @@
+import datetime
+import os
+
+# with time_increment=1 the insights api returns one row per day, so a single request can
+# cover many days.  Cap the window so one request doesn't run into api timeouts
+max_window_days = int(os.getenv("INSIGHTS_WINDOW_DAYS", "30"))
+
+
+# every day from start to end inclusive as YYYY-MM-DD strings
+def days_between(start, end):
+    days = []
+    day = start
+    while day <= end:
+        days.append(day.strftime("%Y-%m-%d"))
+        day = day + datetime.timedelta(days=1)
+    return days
+
+
+# group days into as few {"since", "until"} time ranges as possible.  Only consecutive
+# days are merged so gaps in the list are never fetched
+def plan_windows(days, max_days=None):
+    if max_days is None:
+        max_days = max_window_days
+    dates = sorted({datetime.date.fromisoformat(day) for day in days})
+
+    time_ranges = []
+    since = None
+    until = None
+    for date in dates:
+        if (
+            since is not None
+            and date == until + datetime.timedelta(days=1)
+            and (date - since).days < max_days
+        ):
+            until = date
+            continue
+        if since is not None:
+            time_ranges.append(time_range(since, until))
+        since = date
+        until = date
+    if since is not None:
+        time_ranges.append(time_range(since, until))
+    return time_ranges
+
+
+def time_range(since, until):
+    return {"since": since.strftime("%Y-%m-%d"), "until": until.strftime("%Y-%m-%d")}